@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
+import json
+import hashlib
+import weakref
 import logging
 import numpy as np
 import pandas as pd
 import pkg_resources
-import itertools as it
+from functools import cached_property
 from crispy.Utils import Utils
+from crispy.Store import Store
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.stats import shapiro, iqr
 from sklearn.mixture import GaussianMixture
 from sklearn.preprocessing import quantile_transform
@@ -21,8 +27,13 @@ class Sample:
     """
     Import module that handles the sample list (i.e. list of cell lines) and their descriptive information.
 
+    The merged samplesheet is built once per process for each set of files and snapshot to disk (Parquet) next to the
+    samplesheet file, the snapshot is rebuilt if any of the source files changes.
+
     """
 
+    CACHE = {}
+
     def __init__(
         self,
         index="model_id",
@@ -33,40 +44,97 @@ class Sample:
     ):
         self.index = index
 
+        self.samplesheet_file = samplesheet_file
+        self.growth_file = growth_file
+        self.medium_file = medium_file
+        self.institute_file = institute_file
+
+        self.samplesheet = self.load().copy()
+
+    @property
+    def files(self):
+        return [
+            self.samplesheet_file,
+            self.growth_file,
+            self.medium_file,
+            self.institute_file,
+        ]
+
+    @property
+    def snapshot_file(self):
+        key = hashlib.md5(";".join([self.index] + self.files).encode()).hexdigest()
+        return f"{DPATH}/{self.samplesheet_file}.{key[:8]}.parquet"
+
+    def load(self):
+        """
+        Merged samplesheet, from memory or from the Parquet snapshot if up to date.
+
+        :return: pandas.DataFrame
+        """
+        key = tuple([self.index] + self.files)
+        sources = [f"{DPATH}/{f}" for f in self.files]
+
+        signature = Store.signature(sources)
+
+        if key in self.CACHE and Store.same_signature(self.CACHE[key][0], signature):
+            return self.CACHE[key][1]
+
+        samplesheet = Store.cached(
+            self.snapshot_file,
+            sources,
+            self.build_samplesheet,
+            pd.read_parquet,
+            lambda df, f: df.to_parquet(f),
+            name="Samplesheet snapshot",
+        )
+
+        self.CACHE[key] = (signature, samplesheet)
+
+        return samplesheet
+
+    @cached_property
+    def growth(self):
+        return pd.read_csv(f"{DPATH}/{self.growth_file}")
+
+    @cached_property
+    def media(self):
+        media = pd.read_excel(f"{DPATH}/{self.medium_file}")
+        return media.groupby("SIDM")["Screen Media"].first()
+
+    def build_samplesheet(self):
         # Import samplesheet
-        self.samplesheet = (
-            pd.read_csv(f"{DPATH}/{samplesheet_file}")
+        samplesheet = (
+            pd.read_csv(f"{DPATH}/{self.samplesheet_file}")
             .dropna(subset=[self.index])
             .set_index(self.index)
         )
 
         # Growth rates
-        self.growth = pd.read_csv(f"{DPATH}/{growth_file}")
-        self.samplesheet["growth"] = (
+        samplesheet["growth"] = (
             self.growth.groupby(self.index)["GROWTH_RATE"]
             .mean()
-            .reindex(self.samplesheet.index)
+            .reindex(samplesheet.index)
             .values
         )
 
         # CRISPR institute
-        self.samplesheet["institute"] = (
-            pd.read_csv(f"{DPATH}/{institute_file}", index_col=0, header=None)
+        samplesheet["institute"] = (
+            pd.read_csv(f"{DPATH}/{self.institute_file}", index_col=0, header=None)
             .iloc[:, 0]
-            .reindex(self.samplesheet.index)
+            .reindex(samplesheet.index)
             .values
         )
 
         # Breakdown tissue type
-        self.samplesheet["model_type"] = [
+        samplesheet["model_type"] = [
             c if t in ["Lung", "Haematopoietic and Lymphoid"] else t
-            for t, c in self.samplesheet[["tissue", "cancer_type"]].values
+            for t, c in samplesheet[["tissue", "cancer_type"]].values
         ]
 
         # Screen medium
-        self.media = pd.read_excel(f"{DPATH}/{medium_file}")
-        self.media = self.media.groupby("SIDM")["Screen Media"].first()
-        self.samplesheet["media"] = self.media.reindex(self.samplesheet.index)
+        samplesheet["media"] = self.media.reindex(samplesheet.index)
+
+        return samplesheet
 
     def get_covariates(self, culture_conditions=True, cancer_type=True):
         covariates = []
@@ -91,7 +159,7 @@ class Sample:
 
 class WES:
     def __init__(self, wes_file="WES_variants.csv.gz"):
-        self.wes = pd.read_csv(f"{DPATH}/wes/{wes_file}")
+        self.wes = Store.table(f"{DPATH}/wes/{wes_file}")
 
     def get_data(self, as_matrix=True, mutation_class=None, recurrence=False):
         df = self.wes.copy()
@@ -157,11 +225,11 @@ class GeneExpression:
         voom_file="gexp/rnaseq_voom.csv.gz",
         read_count="gexp/rnaseq_20191101/rnaseq_read_count_20191101.csv",
     ):
-        self.voom = pd.read_csv(f"{DPATH}/{voom_file}", index_col=0)
-        self.readcount = pd.read_csv(f"{DPATH}/{read_count}", index_col=1).drop(
+        self.voom = Store.matrix(f"{DPATH}/{voom_file}", index_col=0)
+        self.readcount = Store.table(f"{DPATH}/{read_count}", index_col=1).drop(
             columns=["model_id"]
         )
-        self.discrete = pd.read_csv(
+        self.discrete = Store.table(
             f"{DPATH}/GDSC_discretised_table.csv.gz", index_col=0
         )
 
@@ -241,7 +309,7 @@ class DrugResponse:
         drugresponse_file="drugresponse/DrugResponse_PANCANCER_GDSC1_GDSC2_20200602.csv.gz",
     ):
         # Import and Merge drug response matrix (IC50)
-        self.drugresponse = pd.read_csv(f"{DPATH}/{drugresponse_file}")
+        self.drugresponse = Store.table(f"{DPATH}/{drugresponse_file}")
         self.drugresponse = self.drugresponse[
             ~self.drugresponse["cell_line_name"].isin(["LS-1034"])
         ]
@@ -321,6 +389,260 @@ class DrugResponse:
         return self.get_data(dtype=dtype).loc[df.index, df.columns]
 
 
+class UniProt:
+    """
+    UniProt human ID mapping to primary gene symbols, shared by the importers. The mapping is parsed once per process
+    and its compact version (IDs and gene symbols) persisted in the Store.
+
+    """
+
+    CACHE = {}
+
+    ID_COLUMNS = ["Entry", "Entry name"]
+    SYMBOL_COLUMN = "Gene names  (primary )"
+
+    def __init__(self, idmap_file="uniprot_human_idmap.tab.gz", ddir=None):
+        self.ddir = DPATH if ddir is None else ddir
+        self.idmap_file = f"{self.ddir}/{idmap_file}"
+
+    @staticmethod
+    def primary_symbol(names):
+        return names.str.split("; ", n=1).str[0]
+
+    def idmap(self, index_col="Entry name"):
+        """
+        Full ID mapping table with the primary gene symbol (GeneSymbol).
+
+        :param index_col: String ID column to use as index (None keeps the default index)
+        :return: pandas.DataFrame
+        """
+        idmap = Store.table(self.idmap_file, sep="\t")
+
+        if index_col is not None:
+            idmap = idmap.dropna(subset=[index_col]).set_index(index_col)
+
+        idmap["GeneSymbol"] = self.primary_symbol(idmap[self.SYMBOL_COLUMN])
+
+        return idmap
+
+    def symbols(self, index_col="Entry name"):
+        """
+        Gene symbol of each UniProt ID, NaN if the protein has no gene name.
+
+        :param index_col: String ID column ("Entry" or "Entry name")
+        :return: pandas.Series
+        """
+        key = (self.idmap_file, index_col)
+
+        if key not in self.CACHE:
+            idmap = Store.table(
+                self.idmap_file,
+                sep="\t",
+                usecols=self.ID_COLUMNS + [self.SYMBOL_COLUMN],
+            ).dropna(subset=[index_col])
+
+            symbols = pd.Series(
+                self.primary_symbol(idmap[self.SYMBOL_COLUMN]).values,
+                index=idmap[index_col].values,
+                name="GeneSymbol",
+            )
+
+            self.CACHE[key] = symbols[~symbols.index.duplicated()]
+
+        return self.CACHE[key]
+
+    def map(self, ids, index_col="Entry name"):
+        """
+        Batch map of UniProt IDs to gene symbols.
+
+        :param ids: list-like of UniProt IDs
+        :param index_col: String ID column ("Entry" or "Entry name")
+        :return: pandas.Series indexed by ids (NaN if not mapped)
+        """
+        return self.symbols(index_col).reindex(ids)
+
+
+class InteractionIndex:
+    """
+    Compact index of protein-protein interactions. Gene symbols are dictionary encoded (nodes) and interactions stored
+    as int32 edge arrays (both directions, i.e. p1-p2 and p2-p1) sorted by (p1, p2), so that membership queries are
+    vectorised binary searches. Optionally, a value (e.g. complex id) is stored for each edge.
+
+    Supports `(p1, p2) in index` for single queries and contains(pairs) for batches.
+
+    """
+
+    def __init__(self, nodes, edges, values=None):
+        self.nodes = np.asarray(nodes)
+        self.edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+        self.values = None if values is None else np.asarray(values)
+
+        self.nodes_index = pd.Index(self.nodes)
+        self.keys = self.encode_keys(self.edges[:, 0], self.edges[:, 1])
+
+    def encode_keys(self, c1, c2):
+        return np.asarray(c1, dtype=np.int64) * len(self.nodes) + c2
+
+    @classmethod
+    def from_pairs(cls, p1, p2, values=None, symmetric=True):
+        """
+        Build the index from two arrays of interacting gene symbols.
+
+        :param p1: list-like of gene symbols
+        :param p2: list-like of gene symbols
+        :param values: list-like of edge values, the last value is kept for duplicated edges
+        :param symmetric: Boolean add interactions in both directions
+        :return: InteractionIndex
+        """
+        p1, p2 = np.asarray(p1, dtype=object), np.asarray(p2, dtype=object)
+
+        codes, nodes = pd.factorize(np.concatenate([p1, p2]), sort=True)
+        edges = codes.reshape(2, -1).T
+
+        if symmetric:
+            edges = np.concatenate([edges, edges[:, ::-1]])
+
+            if values is not None:
+                values = np.concatenate([values, values])
+
+        # Sort edges and remove duplicates (keeping last)
+        keys = edges[:, 0].astype(np.int64) * len(nodes) + edges[:, 1]
+
+        order = np.argsort(keys, kind="stable")[::-1]
+        _, last = np.unique(keys[order], return_index=True)
+        order = order[last]
+
+        return cls(
+            nodes=np.asarray(nodes, dtype=str),
+            edges=edges[order],
+            values=None if values is None else np.asarray(values)[order],
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as f:
+            return cls(
+                nodes=f["nodes"],
+                edges=f["edges"],
+                values=f["values"] if "values" in f else None,
+            )
+
+    def save(self, file_path):
+        arrays = dict(nodes=self.nodes, edges=self.edges)
+
+        if self.values is not None:
+            arrays["values"] = self.values
+
+        with open(file_path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def cached(cls, source_files, params, build_func):
+        """
+        Load the index from the disk cache next to the first source file (Store.cached), built with build_func if
+        missing or if any of the source files changed. The cache file is named after params only, so each set of
+        parameters has a single cache file.
+
+        :param source_files: list of file paths the index is built from (e.g. interactions database, ID mapping)
+        :param params: dict of parameters used to build the index
+        :param build_func: function returning an InteractionIndex
+        :return: InteractionIndex
+        """
+        key = json.dumps(params, sort_keys=True, default=str)
+        key = hashlib.md5(key.encode()).hexdigest()[:8]
+
+        return Store.cached(
+            f"{source_files[0]}.{key}.npz",
+            source_files,
+            build_func,
+            cls.load,
+            lambda index, f: index.save(f),
+            name="Interactions index cache",
+        )
+
+    def encode(self, symbols):
+        return self.nodes_index.get_indexer(symbols)
+
+    def find(self, p1, p2):
+        """
+        Position of the edges p1-p2 in the index (-1 if absent).
+
+        :param p1: list-like of gene symbols
+        :param p2: list-like of gene symbols
+        :return: numpy.ndarray
+        """
+        c1, c2 = self.encode(p1), self.encode(p2)
+
+        if len(self.keys) == 0:
+            return np.full(len(c1), -1)
+
+        keys = self.encode_keys(c1, c2)
+
+        pos = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        found = (c1 >= 0) & (c2 >= 0) & (self.keys[pos] == keys)
+
+        return np.where(found, pos, -1)
+
+    def contains(self, pairs):
+        """
+        Vectorised membership of interactions.
+
+        :param pairs: list-like of (p1, p2) tuples or pandas.DataFrame with two columns
+        :return: numpy.ndarray of Boolean
+        """
+        pairs = np.asarray(pairs, dtype=object).reshape(-1, 2)
+        return self.find(pairs[:, 0], pairs[:, 1]) >= 0
+
+    def get(self, pairs, default=np.nan):
+        """
+        Value of the interactions (default if absent).
+
+        :param pairs: list-like of (p1, p2) tuples
+        :return: numpy.ndarray
+        """
+        pairs = np.asarray(pairs, dtype=object).reshape(-1, 2)
+        pos = self.find(pairs[:, 0], pairs[:, 1])
+        return np.where(pos >= 0, self.values[pos], default)
+
+    def filter(self, mask):
+        return InteractionIndex(
+            nodes=self.nodes,
+            edges=self.edges[mask],
+            values=None if self.values is None else self.values[mask],
+        )
+
+    def drop_self(self):
+        return self.filter(self.edges[:, 0] != self.edges[:, 1])
+
+    def subset(self, symbols):
+        nodes = np.isin(self.nodes, list(symbols))
+        return self.filter(nodes[self.edges[:, 0]] & nodes[self.edges[:, 1]])
+
+    def adjacency(self):
+        """
+        Adjacency matrix of the interactions (nodes x nodes).
+
+        :return: scipy.sparse.csr_matrix
+        """
+        n_nodes = len(self.nodes)
+        return csr_matrix(
+            (np.ones(len(self.edges), dtype=bool), tuple(self.edges.T)),
+            shape=(n_nodes, n_nodes),
+        )
+
+    def pairs(self):
+        return pd.DataFrame(self.nodes[self.edges], columns=["p1", "p2"])
+
+    def __contains__(self, pair):
+        return bool(self.contains([pair])[0])
+
+    def __iter__(self):
+        return iter(map(tuple, self.nodes[self.edges].tolist()))
+
+    def __len__(self):
+        return len(self.edges)
+
+
 class BioGRID:
     def __init__(
         self,
@@ -342,45 +664,203 @@ class BioGRID:
             else stypes_exclude
         )
 
-        # Import
-        self.biogrid = pd.read_csv(f"{self.ddir}/{biogrid_file}", sep="\t")
+        # Import interactions index
+        self.biogrid = InteractionIndex.cached(
+            [f"{self.ddir}/{biogrid_file}"],
+            dict(
+                organism=self.organism,
+                etype=self.etype,
+                stypes_exclude=sorted(self.stypes_exclude),
+                homodymers_exclude=self.homodymers_exclude,
+            ),
+            lambda: self.build_index(f"{self.ddir}/{biogrid_file}"),
+        )
+
+    def build_index(self, biogrid_file):
+        biogrid = pd.read_csv(
+            biogrid_file,
+            sep="\t",
+            usecols=[
+                "Organism Interactor A",
+                "Organism Interactor B",
+                "Experimental System",
+                "Experimental System Type",
+                "Official Symbol Interactor A",
+                "Official Symbol Interactor B",
+            ],
+        )
 
         # Filter by organism
-        self.biogrid = self.biogrid[
-            self.biogrid["Organism Interactor A"] == self.organism
-        ]
-        self.biogrid = self.biogrid[
-            self.biogrid["Organism Interactor B"] == self.organism
-        ]
+        biogrid = biogrid[biogrid["Organism Interactor A"] == self.organism]
+        biogrid = biogrid[biogrid["Organism Interactor B"] == self.organism]
 
         # Filter by type of interaction
         if self.etype is not None:
-            self.biogrid = self.biogrid[
-                self.biogrid["Experimental System Type"] == self.etype
-            ]
+            biogrid = biogrid[biogrid["Experimental System Type"] == self.etype]
 
         # Exlude experimental systems
-        self.biogrid = self.biogrid[
-            ~self.biogrid["Experimental System"].isin(self.stypes_exclude)
-        ]
+        biogrid = biogrid[~biogrid["Experimental System"].isin(self.stypes_exclude)]
 
         # Exclude homodymers
         if self.homodymers_exclude:
-            self.biogrid = self.biogrid[
-                self.biogrid["Official Symbol Interactor A"]
-                != self.biogrid["Official Symbol Interactor B"]
+            biogrid = biogrid[
+                biogrid["Official Symbol Interactor A"]
+                != biogrid["Official Symbol Interactor B"]
             ]
 
-        # Build set of interactions (both directions, i.e. p1-p2, p2-p1)
-        self.biogrid = {
-            (p1, p2)
-            for p1, p2 in self.biogrid[
-                ["Official Symbol Interactor A", "Official Symbol Interactor B"]
-            ].values
-        }
-        self.biogrid = {
-            (p1, p2) for p in self.biogrid for p1, p2 in [(p[0], p[1]), (p[1], p[0])]
-        }
+        # Index of interactions (both directions, i.e. p1-p2, p2-p1)
+        return InteractionIndex.from_pairs(
+            biogrid["Official Symbol Interactor A"].astype(str),
+            biogrid["Official Symbol Interactor B"].astype(str),
+        )
+
+
+class PPIDistances:
+    """
+    Index of shortest path distances between the vertices of a PPI network. Distances are calculated with a
+    breadth-first search (in batches of sources) truncated at max_dist and stored as a uint8 matrix (sources x
+    vertices): distances >= max_dist are stored as max_dist and unreachable vertices as UNREACHABLE.
+
+    """
+
+    UNREACHABLE = 255
+
+    def __init__(self, sources, vertices, dist, max_dist, network=""):
+        self.sources = pd.Index(sources)
+        self.vertices = pd.Index(vertices)
+        self.dist = np.asarray(dist, dtype=np.uint8)
+        self.max_dist = int(max_dist)
+        self.network = str(network)
+
+    @staticmethod
+    def network_signature(ppi):
+        md5 = hashlib.md5("\t".join(ppi.vs["name"]).encode())
+        md5.update(np.array(ppi.get_edgelist(), dtype=np.int64).tobytes())
+        return md5.hexdigest()
+
+    @classmethod
+    def from_graph(cls, ppi, max_dist, sources=None, batch_size=1024):
+        """
+        :param ppi: igraph.Graph PPI network
+        :param max_dist: Int maximum distance searched (< 255)
+        :param sources: list-like of source vertices names, if None all vertices are used
+        :param batch_size: Int number of sources searched at a time
+        :return: PPIDistances
+        """
+        assert 0 < max_dist < cls.UNREACHABLE, f"max_dist out of ]0, {cls.UNREACHABLE}["
+
+        vertices = pd.Index(ppi.vs["name"])
+
+        if sources is None:
+            sources = vertices
+        else:
+            sources = vertices[vertices.isin(list(sources))]
+
+        # Adjacency matrix
+        edges = np.array(ppi.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        edges = np.concatenate([edges, edges[:, ::-1]])
+
+        adj = csr_matrix(
+            (np.ones(len(edges)), (edges[:, 0], edges[:, 1])),
+            shape=(len(vertices), len(vertices)),
+        )
+
+        # Connected components, vertices in different components are unreachable
+        _, components = connected_components(adj, directed=False)
+
+        dist = np.full((len(sources), len(vertices)), cls.UNREACHABLE, dtype=np.uint8)
+
+        sources_idx = vertices.get_indexer(sources)
+
+        for i in range(0, len(sources_idx), batch_size):
+            idx = sources_idx[i : i + batch_size]
+            rows = np.arange(len(idx))
+
+            # Breadth-first search of all sources in the batch, level by level
+            frontier = np.zeros((len(idx), len(vertices)), dtype=bool)
+            frontier[rows, idx] = True
+
+            visited = frontier.copy()
+            batch_dist = dist[i : i + batch_size]
+            batch_dist[rows, idx] = 0
+
+            for d in range(1, max_dist):
+                frontier = (adj.dot(frontier.T.astype(np.float64)).T > 0) & ~visited
+
+                if not frontier.any():
+                    break
+
+                batch_dist[frontier] = d
+                visited |= frontier
+
+            # Reachable vertices further than max_dist - 1
+            reachable = components[idx][:, None] == components[None, :]
+            batch_dist[reachable & ~visited] = max_dist
+
+        return cls(sources, vertices, dist, max_dist, cls.network_signature(ppi))
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as f:
+            return cls(
+                f["sources"], f["vertices"], f["dist"], f["max_dist"], f["network"]
+            )
+
+    def save(self, file_path):
+        with open(file_path, "wb") as f:
+            np.savez(
+                f,
+                sources=np.asarray(self.sources, dtype=str),
+                vertices=np.asarray(self.vertices, dtype=str),
+                dist=self.dist,
+                max_dist=self.max_dist,
+                network=self.network,
+            )
+
+    @classmethod
+    def cached(cls, ppi, max_dist, file_path):
+        """
+        Load the all-pairs distance index from file_path, rebuilt if missing or computed for a different network or
+        smaller max_dist.
+
+        :return: PPIDistances
+        """
+
+        def read(f):
+            distances = cls.load(f)
+
+            if (
+                distances.max_dist >= max_dist
+                and distances.network == cls.network_signature(ppi)
+                and len(distances.sources) == len(distances.vertices)
+            ):
+                return distances
+
+        # Validity depends on the network, not on source files
+        return Store.cached(
+            file_path,
+            [],
+            lambda: cls.from_graph(ppi, max_dist),
+            read,
+            lambda distances, f: distances.save(f),
+            name="PPI distances",
+        )
+
+    def contains(self, names):
+        return pd.Index(names).isin(self.vertices)
+
+    def distances(self, sources, targets):
+        """
+        Vectorised distance lookup, UNREACHABLE if any of the genes is not in the index.
+
+        :param sources: list-like of source vertices names
+        :param targets: list-like of target vertices names
+        :return: numpy.ndarray of uint8
+        """
+        s, t = self.sources.get_indexer(sources), self.vertices.get_indexer(targets)
+
+        d = self.dist[s.clip(min=0), t.clip(min=0)] if len(self.sources) > 0 else 0
+        return np.where((s >= 0) & (t >= 0), d, self.UNREACHABLE).astype(np.uint8)
 
 
 class PPI:
@@ -389,6 +869,8 @@ class PPI:
 
     """
 
+    SUBGRAPHS = {}
+
     def __init__(
         self,
         string_file="9606.protein.links.full.v11.0.txt.gz",
@@ -402,54 +884,68 @@ class PPI:
 
     @classmethod
     def ppi_annotation(
-        cls, df, ppi, target_thres=5, y_var="y_id", x_var="x_id", ppi_var="x_ppi"
+        cls,
+        df,
+        ppi,
+        target_thres=5,
+        y_var="y_id",
+        x_var="x_id",
+        ppi_var="x_ppi",
+        distances=None,
     ):
-        genes_source = set(
-            {g for v in df[y_var].dropna() for g in v.split(";")}
-        ).intersection(set(ppi.vs["name"]))
-        genes_target = set(
-            {g for v in df[x_var].dropna() for g in v.split(";")}
-        ).intersection(set(ppi.vs["name"]))
-
-        # Calculate distance between drugs and genes in PPI
-        dist_g_g = {
-            g: pd.Series(
-                ppi.shortest_paths(source=g, target=genes_target)[0], index=genes_target
-            ).to_dict()
-            for g in genes_source
-        }
+        """
+        Annotate the PPI distance between the genes in y_var and x_var (multiple genes separated by ";").
+
+        :param df: pandas.DataFrame associations
+        :param ppi: igraph.Graph PPI network
+        :param target_thres: Int distances equal or above are reported as "{target_thres}+"
+        :param distances: PPIDistances precomputed index of ppi, if None (or computed for another network or a
+            smaller max_dist) distances are calculated for the genes in df
+        :return: pandas.DataFrame
+        """
+        pairs = df[[y_var, x_var]].drop_duplicates().reset_index(drop=True)
 
-        def gene_gene_annot(g_source, g_target):
-            if str(g_source) == "nan" or str(g_target) == "nan":
-                res = np.nan
+        g_source, g_target = pairs[y_var], pairs[x_var]
 
-            elif len(set(g_source.split(";")).intersection(g_target.split(";"))) > 0:
-                res = "T"
+        if (
+            distances is not None
+            and distances.network != PPIDistances.network_signature(ppi)
+        ):
+            LOG.warning("PPI distances computed for a different network, recalculated")
+            distances = None
 
-            elif g_source not in genes_source:
-                res = "-"
+        if distances is None or distances.max_dist < target_thres:
+            sources = {g for v in g_source.dropna() for g in v.split(";")}
+            distances = PPIDistances.from_graph(ppi, target_thres, sources=sources)
 
-            elif g_target not in genes_target:
-                res = "-"
+        # Distance between genes in PPI
+        d = distances.distances(g_source.astype(str), g_target.astype(str))
 
-            else:
-                g_st_min = np.min(
-                    [
-                        dist_g_g[gs][gt]
-                        for gs in g_source.split(";")
-                        for gt in g_target.split(";")
-                    ]
-                )
-                res = cls.ppi_dist_to_string(g_st_min, target_thres)
+        labels = [cls.ppi_dist_to_string(i, target_thres) for i in range(target_thres)]
+        labels = np.array(labels + [f"{int(target_thres)}+", "-"], dtype=object)
+
+        d = d.astype(int)
+        d = np.where(d == PPIDistances.UNREACHABLE, -1, d.clip(max=target_thres))
+        annot = labels[d]
 
-            return res
+        # Genes not in the network
+        annot[~(distances.contains(g_source) & distances.contains(g_target))] = "-"
+
+        # Shared genes between source and target
+        shared = pairs.assign(
+            s=g_source.str.split(";"), t=g_target.str.split(";")
+        ).explode("s").explode("t")
+        shared = (shared["s"] == shared["t"]).groupby(level=0).any()
+        annot[shared.reindex(pairs.index).values] = "T"
+
+        # Missing values
+        annot[(g_source.isna() | g_target.isna()).values] = np.nan
+
+        annot = pd.Series(annot, index=pd.MultiIndex.from_frame(pairs))
 
         # Annotate drug regressions
         df = df.assign(
-            x_ppi=[
-                gene_gene_annot(g_source, g_target)
-                for g_source, g_target in df[[y_var, x_var]].values
-            ]
+            x_ppi=annot.reindex(pd.MultiIndex.from_frame(df[[y_var, x_var]])).values
         )
         df = df.rename(columns=dict(x_ppi=ppi_var))
 
@@ -471,63 +967,125 @@ class PPI:
 
         return res
 
-    def build_string_ppi(self, score_thres=900, export_pickle=None):
+    def string_ppi_file(self, score_thres):
+        return f"{self.ddir}/{self.string_file}.{score_thres}.pickle"
+
+    def build_string_ppi(self, score_thres=900, export_pickle=None, cache=True):
+        """
+        STRING network of gene symbols with combined score > score_thres. The network is cached (pickle) next to the
+        STRING file for each score_thres and rebuilt if the content of the STRING files changes.
+
+        :param score_thres: Int minimum combined score (exclusive)
+        :param export_pickle: String file path to export the network
+        :param cache: Boolean use and write the network cache
+        :return: igraph.Graph
+        """
         import igraph
 
-        # ENSP map to gene symbol
-        gmap = pd.read_csv(f"{self.ddir}/{self.string_alias_file}", sep="\t")
-        gmap = gmap[["BioMart_HUGO" in i.split(" ") for i in gmap["source"]]]
-        gmap = (
-            gmap.groupby("string_protein_id")["alias"].agg(lambda x: set(x)).to_dict()
+        net_i = Store.cached(
+            self.string_ppi_file(score_thres),
+            [
+                f"{self.ddir}/{self.string_file}",
+                f"{self.ddir}/{self.string_alias_file}",
+            ],
+            lambda: self.string_ppi(score_thres),
+            igraph.Graph.Read_Pickle,
+            lambda net, f: net.write_pickle(f),
+            cache=cache,
+            content=True,
+            name="String network cache",
         )
-        gmap = {k: list(gmap[k])[0] for k in gmap if len(gmap[k]) == 1}
-        logging.getLogger("DTrace").info(f"ENSP gene map: {len(gmap)}")
+
+        LOG.info(net_i.summary())
+
+        # Export
+        if export_pickle is not None:
+            net_i.write_pickle(export_pickle)
+
+        return net_i
+
+    def string_ppi(self, score_thres=900):
+        import igraph
+
+        # ENSP map to gene symbol (proteins mapped to a single HUGO symbol)
+        gmap = pd.read_csv(f"{self.ddir}/{self.string_alias_file}", sep="\t")
+        gmap = gmap[gmap["source"].str.contains(r"(?:^| )BioMart_HUGO(?: |$)")]
+        gmap = gmap.drop_duplicates(subset=["string_protein_id", "alias"])
+        gmap = gmap[~gmap["string_protein_id"].duplicated(keep=False)]
+        gmap = gmap.set_index("string_protein_id")["alias"]
+        LOG.info(f"ENSP gene map: {len(gmap)}")
 
         # Load String network
-        net = pd.read_csv(f"{self.ddir}/{self.string_file}", sep=" ")
+        net = pd.read_csv(
+            f"{self.ddir}/{self.string_file}",
+            sep=" ",
+            usecols=["protein1", "protein2", "combined_score"],
+        )
 
         # Filter by moderate confidence
         net = net[net["combined_score"] > score_thres]
 
         # Filter and map to gene symbol
-        net = net[
-            [
-                p1 in gmap and p2 in gmap
-                for p1, p2 in net[["protein1", "protein2"]].values
-            ]
-        ]
-        net["protein1"] = [gmap[p1] for p1 in net["protein1"]]
-        net["protein2"] = [gmap[p2] for p2 in net["protein2"]]
+        net = net[net["protein1"].isin(gmap.index) & net["protein2"].isin(gmap.index)]
         LOG.info(f"String: {len(net)}")
 
-        #  String network
-        net_i = igraph.Graph(directed=False)
-
-        # Initialise network lists
-        edges = [(px, py) for px, py in net[["protein1", "protein2"]].values]
-        vertices = list(set(net["protein1"]).union(net["protein2"]))
+        p1 = gmap.reindex(net["protein1"]).values
+        p2 = gmap.reindex(net["protein2"]).values
+        codes, vertices = pd.factorize(np.concatenate([p1, p2]), sort=True)
 
-        # Add nodes
-        net_i.add_vertices(vertices)
-
-        # Add edges
-        net_i.add_edges(edges)
+        #  String network
+        net_i = igraph.Graph(
+            n=len(vertices), edges=codes.reshape(2, -1).T, directed=False
+        )
+        net_i.vs["name"] = list(vertices)
 
         # Add edge attribute score
-        net_i.es["score"] = list(net["combined_score"])
+        net_i.es["score"] = net["combined_score"].tolist()
 
         # Simplify
         net_i = net_i.simplify(combine_edges="max")
-        LOG.info(net_i.summary())
-
-        # Export
-        if export_pickle is not None:
-            net_i.write_pickle(export_pickle)
 
         return net_i
 
+    def build_string_distances(self, score_thres=900, max_dist=5):
+        """
+        All-pairs distances index of the STRING network, cached next to the network.
+
+        :param score_thres: Int minimum combined score (exclusive)
+        :param max_dist: Int maximum distance searched
+        :return: PPIDistances
+        """
+        return PPIDistances.cached(
+            self.build_string_ppi(score_thres=score_thres),
+            max_dist,
+            f"{self.string_ppi_file(score_thres)}.distances.npz",
+        )
+
     @staticmethod
-    def ppi_corr(ppi, m_corr, m_corr_thres=None):
+    def edges_corr(m_corr, sources, targets, chunk_size=2 ** 16):
+        """
+        Pearson correlation between the rows sources and targets of m_corr (row-wise dot products of the
+        standardised rows).
+
+        :param m_corr: pandas.DataFrame
+        :param sources: numpy.ndarray of Int positions of the rows
+        :param targets: numpy.ndarray of Int positions of the rows
+        :return: numpy.ndarray
+        """
+        values = m_corr.values.astype(float)
+
+        z = values - values.mean(1, keepdims=True)
+        z /= np.sqrt((z ** 2).sum(1, keepdims=True))
+
+        corr = np.empty(len(sources))
+        for i in range(0, len(sources), chunk_size):
+            s, t = sources[i : i + chunk_size], targets[i : i + chunk_size]
+            corr[i : i + chunk_size] = np.einsum("ij,ij->i", z[s], z[t])
+
+        return corr
+
+    @classmethod
+    def ppi_corr(cls, ppi, m_corr, m_corr_thres=None):
         """
         Annotate PPI network based on Pearson correlation between the vertices of each edge using
         m_corr data-frame and m_corr_thres (Pearson > m_corr_thress).
@@ -538,51 +1096,80 @@ class PPI:
         :return:
         """
         # Subset PPI network
-        ppi = ppi.subgraph([i.index for i in ppi.vs if i["name"] in m_corr.index])
+        vertices = pd.Index(ppi.vs["name"])
+        ppi = ppi.subgraph(np.flatnonzero(vertices.isin(m_corr.index)).tolist())
 
         # Edge correlation
-        crispr_pcc = np.corrcoef(m_corr.loc[ppi.vs["name"]].values)
-        ppi.es["corr"] = [crispr_pcc[i.source, i.target] for i in ppi.es]
+        edges = np.array(ppi.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+
+        corr = cls.edges_corr(m_corr.loc[ppi.vs["name"]], edges[:, 0], edges[:, 1])
+        ppi.es["corr"] = corr.tolist()
 
         # Sub-set by correlation between vertices of each edge
         if m_corr_thres is not None:
             ppi = ppi.subgraph_edges(
-                [i.index for i in ppi.es if abs(i["corr"]) > m_corr_thres]
+                np.flatnonzero(np.abs(corr) > m_corr_thres).tolist()
             )
 
         LOG.info(ppi.summary())
 
         return ppi
 
+    @classmethod
+    def corr_subgraph(cls, ppi, corr_thres):
+        """
+        Subgraph of the edges with absolute correlation >= corr_thres. Subgraphs are cached for each network and
+        threshold, the cache is reset if the edges correlations change.
+
+        :param ppi: igraph.Graph annotated with ppi_corr
+        :param corr_thres: Float
+        :return: igraph.Graph
+        """
+        corr = np.array(ppi.es["corr"], dtype=float)
+        signature = hashlib.md5(corr.tobytes()).hexdigest()
+
+        ref, cached_signature, subgraphs = cls.SUBGRAPHS.get(id(ppi), (None, None, {}))
+
+        if ref is None or ref() is not ppi or cached_signature != signature:
+            key, subgraphs = id(ppi), {}
+            ref = weakref.ref(ppi, lambda _: cls.SUBGRAPHS.pop(key, None))
+            cls.SUBGRAPHS[key] = (ref, signature, subgraphs)
+
+        if corr_thres not in subgraphs:
+            subgraphs[corr_thres] = ppi.subgraph_edges(
+                np.flatnonzero(np.abs(corr) >= corr_thres).tolist()
+            )
+
+        return subgraphs[corr_thres]
+
     @classmethod
     def get_edges(cls, ppi, nodes, corr_thres, norder):
         # Subset network
-        ppi_sub = ppi.copy().subgraph_edges(
-            [e for e in ppi.es if abs(e["corr"]) >= corr_thres]
-        )
+        ppi_sub = cls.corr_subgraph(ppi, corr_thres)
 
         # Nodes that are contained in the network
-        nodes = {v for v in nodes if v in ppi_sub.vs["name"]}
+        vertices = pd.Index(ppi_sub.vs["name"])
+        nodes = vertices[vertices.isin(list(nodes))]
         assert len(nodes) > 0, "None of the nodes is contained in the PPI"
 
         # Nodes neighborhood
-        neighbor_nodes = {
-            v for n in nodes for v in ppi_sub.neighborhood(n, order=norder)
-        }
+        neighbor_nodes = np.unique(
+            np.concatenate(ppi_sub.neighborhood(list(nodes), order=norder))
+        )
 
         # Build subgraph
-        subgraph = ppi_sub.subgraph(neighbor_nodes)
+        subgraph = ppi_sub.subgraph(neighbor_nodes.tolist())
 
         # Build data-frame
+        names = np.array(subgraph.vs["name"], dtype=object)
+        edges = np.array(subgraph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+
         nodes_df = pd.DataFrame(
-            [
-                {
-                    "source": subgraph.vs[e.source]["name"],
-                    "target": subgraph.vs[e.target]["name"],
-                    "r": e["corr"],
-                }
-                for e in subgraph.es
-            ]
+            dict(
+                source=names[edges[:, 0]],
+                target=names[edges[:, 1]],
+                r=subgraph.es["corr"],
+            )
         ).sort_values("r")
 
         return nodes_df
@@ -608,50 +1195,58 @@ class CORUM:
         self.db = self.db.query(f"Organism == '{organism}'")
         self.db_name = self.db.groupby("ComplexID")["ComplexName"].first()
 
-        # Melt into list of protein pairs (both directions, i.e. p1-p2, p2-p1)
-        self.db_melt = self.melt_ppi()
-
-        # Map to gene symbols
-        self.gmap = self.map_gene_name()
-        self.db_melt_symbol = {
-            (self.gmap.loc[p1, "GeneSymbol"], self.gmap.loc[p2, "GeneSymbol"]): i
-            for (p1, p2), i in self.db_melt.items()
-            if p1 in self.gmap.index and p2 in self.gmap.index
-        }
+        # Index of protein pairs (gene symbols) mapped to the complex id
+        self.db_melt_symbol = InteractionIndex.cached(
+            [f"{self.ddir}/{corum_file}", UniProt(ddir=self.ddir).idmap_file],
+            dict(organism=self.organism),
+            self.build_index,
+        )
 
         # Exclude homodymers
         if self.homodymers_exclude:
-            self.db_melt_symbol = {
-                (p1, p2): i for (p1, p2), i in self.db_melt_symbol.items() if p1 != p2
-            }
+            self.db_melt_symbol = self.db_melt_symbol.drop_self()
 
         # Subset interactions
         if self.protein_subset is not None:
-            self.db_melt_symbol = {
-                (p1, p2): i
-                for (p1, p2), i in self.db_melt_symbol.items()
-                if p1 in self.protein_subset and p2 in self.protein_subset
-            }
+            self.db_melt_symbol = self.db_melt_symbol.subset(self.protein_subset)
 
-    def melt_ppi(self, idx_id="ComplexID", idx_sub="subunits(UniProt IDs)"):
-        db_melt = self.db[[idx_id, idx_sub]].copy()
-        db_melt[idx_sub] = db_melt[idx_sub].apply(
-            lambda v: list(it.permutations(v.split(";"), 2))
-        )
-        db_melt = {p: i for i, c in db_melt[[idx_id, idx_sub]].values for p in c}
-        return db_melt
+    def build_index(self):
+        # Melt into protein pairs (both directions, i.e. p1-p2, p2-p1)
+        db_melt = self.melt_ppi()
 
-    def map_gene_name(self, index_col="Entry"):
-        idmap = pd.read_csv(f"{self.ddir}/uniprot_human_idmap.tab.gz", sep="\t")
+        # Map to gene symbols
+        gmap = UniProt(ddir=self.ddir).symbols(index_col="Entry")
+        db_melt = db_melt.assign(
+            p1=gmap.reindex(db_melt["p1"]).values, p2=gmap.reindex(db_melt["p2"]).values
+        ).dropna(subset=["p1", "p2"])
+
+        return InteractionIndex.from_pairs(
+            db_melt["p1"],
+            db_melt["p2"],
+            values=db_melt["ComplexID"].values,
+            symmetric=False,
+        )
 
-        if index_col is not None:
-            idmap = idmap.dropna(subset=[index_col]).set_index(index_col)
+    def melt_ppi(self, idx_id="ComplexID", idx_sub="subunits(UniProt IDs)"):
+        """
+        All ordered pairs of subunits (permutations) of each complex.
 
-        idmap["GeneSymbol"] = idmap["Gene names  (primary )"].apply(
-            lambda v: v.split("; ")[0] if str(v).lower() != "nan" else v
+        :return: pandas.DataFrame with p1, p2 and complex id columns
+        """
+        subunits = (
+            self.db[[idx_id, idx_sub]]
+            .assign(p=self.db[idx_sub].str.split(";"))
+            .explode("p")[[idx_id, "p"]]
         )
+        subunits = subunits.assign(pos=subunits.groupby(idx_id).cumcount())
 
-        return idmap
+        db_melt = subunits.merge(subunits, on=idx_id, suffixes=("1", "2"))
+        db_melt = db_melt[db_melt["pos1"] != db_melt["pos2"]]
+
+        return db_melt[["p1", "p2", idx_id]].reset_index(drop=True)
+
+    def map_gene_name(self, index_col="Entry"):
+        return UniProt(ddir=self.ddir).idmap(index_col=index_col)
 
 
 class HuRI:
@@ -714,6 +1309,11 @@ class Metabolomics:
 
 
 class Proteomics:
+    """
+    Import module of proteomics data-sets. Each data-set is read on first access and cached.
+
+    """
+
     def __init__(
         self,
         protein_matrix="proteomics/E0022_P06_Protein_Matrix_ProNorM.tsv.gz",
@@ -727,38 +1327,72 @@ class Proteomics:
         hgsc_prot="proteomics/hgsc_cell_lines_proteomics.csv",
         brca_prot="proteomics/brca_cell_lines_proteomics_preprocessed.csv",
     ):
-        self.ss = pd.read_csv(f"{DPATH}/{samplesheet}", index_col=0)
+        self.files = dict(
+            protein_matrix=protein_matrix,
+            protein_raw_matrix=protein_raw_matrix,
+            protein_mean_raw=protein_mean_raw,
+            protein_rep_corr=protein_rep_corr,
+            manifest=manifest,
+            samplesheet=samplesheet,
+            broad_tmt=broad_tmt,
+            coread_tmt=coread_tmt,
+            hgsc_prot=hgsc_prot,
+            brca_prot=brca_prot,
+        )
 
-        deprecated_ids = self.map_deprecated()
+    @cached_property
+    def ss(self):
+        return pd.read_csv(f"{DPATH}/{self.files['samplesheet']}", index_col=0)
+
+    @cached_property
+    def manifest_all(self):
+        return pd.read_csv(
+            f"{DPATH}/{self.files['manifest']}", index_col=0, sep="\t"
+        )
 
-        # Import manifest
-        self.manifest = pd.read_csv(f"{DPATH}/{manifest}", index_col=0, sep="\t")
+    @cached_property
+    def exclude_man(self):
+        return self.manifest_all[~self.manifest_all["SIDM"].isin(self.ss.index)]
 
+    @cached_property
+    def manifest(self):
         # Remove excluded samples
-        self.exclude_man = self.manifest[~self.manifest["SIDM"].isin(self.ss.index)]
-        self.manifest = self.manifest[~self.manifest.index.isin(self.exclude_man.index)]
+        return self.manifest_all[~self.manifest_all.index.isin(self.exclude_man.index)]
 
+    @cached_property
+    def reps(self):
         # Replicate correlation
-        self.reps = pd.read_csv(f"{DPATH}/{protein_rep_corr}", index_col=0).iloc[:, 0]
+        return pd.read_csv(
+            f"{DPATH}/{self.files['protein_rep_corr']}", index_col=0
+        ).iloc[:, 0]
 
+    @cached_property
+    def protein_raw(self):
         # Import mean protein abundance
-        self.protein_raw = pd.read_csv(
-            f"{DPATH}/{protein_raw_matrix}", sep="\t", index_col=0
+        return Store.matrix(
+            f"{DPATH}/{self.files['protein_raw_matrix']}", sep="\t", index_col=0
         )
-        self.peptide_raw_mean = pd.read_csv(
-            f"{DPATH}/{protein_mean_raw}", sep="\t", index_col=0
+
+    @cached_property
+    def peptide_raw_mean(self):
+        return pd.read_csv(
+            f"{DPATH}/{self.files['protein_mean_raw']}", sep="\t", index_col=0
         ).iloc[:, 0]
 
+    @cached_property
+    def protein(self):
         # Import imputed protein levels
-        self.protein = pd.read_csv(f"{DPATH}/{protein_matrix}", sep="\t", index_col=0).T
+        protein = Store.matrix(
+            f"{DPATH}/{self.files['protein_matrix']}", sep="\t", index_col=0
+        ).T
 
-        self.protein["Protein"] = (
-            self.protein.reset_index()["index"]
-            .replace(deprecated_ids["Entry name"])
-            .values
+        deprecated_ids = self.map_deprecated()
+
+        protein["Protein"] = (
+            protein.reset_index()["index"].replace(deprecated_ids["Entry name"]).values
         )
-        self.protein = self.protein.set_index("Protein")
-        self.protein = self.protein.rename(
+        protein = protein.set_index("Protein")
+        protein = protein.rename(
             columns=self.manifest.groupby("Cell_line")["SIDM"].first()
         )
 
@@ -767,46 +1401,55 @@ class Proteomics:
             "Control_HEK293T_std_H002",
             "Control_HEK293T_std_H003",
         ]
-        self.protein = self.protein.drop(columns=exclude_controls)
+        protein = protein.drop(columns=exclude_controls)
+
+        return protein
 
+    @cached_property
+    def broad(self):
         # Import Broad TMT data-set
-        self.broad = pd.read_csv(f"{DPATH}/{broad_tmt}", compression="gzip")
-        self.broad = (
-            self.broad.dropna(subset=["Gene_Symbol"])
-            .groupby("Gene_Symbol")
-            .agg(np.nanmean)
+        broad = Store.table(f"{DPATH}/{self.files['broad_tmt']}", compression="gzip")
+        broad = (
+            broad.dropna(subset=["Gene_Symbol"]).groupby("Gene_Symbol").agg(np.nanmean)
         )
+        return broad
 
+    @cached_property
+    def coread(self):
         # Import CRC COREAD TMT
-        self.coread = pd.read_csv(f"{DPATH}/{coread_tmt}", index_col=0)
-        self.coread = self.coread.loc[
-            :, self.coread.columns.isin(self.ss["model_name"])
-        ]
-
-        coread_ss = self.ss[self.ss["model_name"].isin(self.coread.columns)]
-        coread_ss = coread_ss.reset_index().set_index("model_name")
-        self.coread = self.coread.rename(columns=coread_ss["model_id"])
+        coread = pd.read_csv(f"{DPATH}/{self.files['coread_tmt']}", index_col=0)
+        return self.rename_model_names(coread)
 
+    @cached_property
+    def hgsc(self):
         # Import HGSC proteomics
-        self.hgsc = (
-            pd.read_csv(f"{DPATH}/{hgsc_prot}")
+        hgsc = (
+            pd.read_csv(f"{DPATH}/{self.files['hgsc_prot']}")
             .dropna(subset=["Gene names"])
             .drop(columns=["Majority protein IDs"])
         )
-        self.hgsc = self.hgsc.groupby("Gene names").mean()
-        self.hgsc = self.hgsc.loc[:, self.hgsc.columns.isin(self.ss["model_name"])]
-
-        hgsc_ss = self.ss[self.ss["model_name"].isin(self.hgsc.columns)]
-        hgsc_ss = hgsc_ss.reset_index().set_index("model_name")
-        self.hgsc = self.hgsc.rename(columns=hgsc_ss["model_id"])
+        hgsc = hgsc.groupby("Gene names").mean()
+        return self.rename_model_names(hgsc)
 
+    @cached_property
+    def brca(self):
         # Import BRCA proteomics
-        self.brca = pd.read_csv(f"{DPATH}/{brca_prot}", index_col=0)
-        self.brca = self.brca.loc[:, self.brca.columns.isin(self.ss["model_name"])]
+        brca = pd.read_csv(f"{DPATH}/{self.files['brca_prot']}", index_col=0)
+        return self.rename_model_names(brca)
+
+    def rename_model_names(self, df):
+        """
+        Subset columns to the cell lines (model names) in the samplesheet and rename them to model ids.
 
-        brca_ss = self.ss[self.ss["model_name"].isin(self.brca.columns)]
-        brca_ss = brca_ss.reset_index().set_index("model_name")
-        self.brca = self.brca.rename(columns=brca_ss["model_id"])
+        :param df: pandas.DataFrame proteins x cell lines (model names)
+        :return: pandas.DataFrame
+        """
+        df = df.loc[:, df.columns.isin(self.ss["model_name"])]
+
+        df_ss = self.ss[self.ss["model_name"].isin(df.columns)]
+        df_ss = df_ss.reset_index().set_index("model_name")
+
+        return df.rename(columns=df_ss["model_id"])
 
     def get_data(self, dtype="protein", map_ids=True, quantile_normalise=False):
         if dtype.lower() == "protein":
@@ -823,7 +1466,7 @@ class Proteomics:
             )
 
         if map_ids:
-            pmap = self.map_gene_name().reindex(data.index)["GeneSymbol"].dropna()
+            pmap = UniProt().map(data.index).dropna()
 
             data = data[data.index.isin(pmap.index)]
             data = data.groupby(pmap.reindex(data.index)).mean()
@@ -881,35 +1524,68 @@ class Proteomics:
 
     @staticmethod
     def map_gene_name(index_col="Entry name"):
-        idmap = pd.read_csv(f"{DPATH}/uniprot_human_idmap.tab.gz", sep="\t")
+        return UniProt().idmap(index_col=index_col)
 
-        if index_col is not None:
-            idmap = idmap.dropna(subset=[index_col]).set_index(index_col)
+    def calculate_mean_protein_intensities(
+        self,
+        peptide_matrix_raw="proteomics/E0022_P06_Peptide_Matrix_Raw.tsv.gz",
+        chunksize=64,
+    ):
+        """
+        Mean raw (log2) protein intensities. The peptide matrix (samples x peptides) is streamed in chunks of samples,
+        log2 intensities are summed, with their counts, per protein and cell line (SIDM) and the protein mean across
+        cell lines is calculated from the protein x cell line means.
 
-        idmap["GeneSymbol"] = idmap["Gene names  (primary )"].apply(
-            lambda v: v.split("; ")[0] if str(v).lower() != "nan" else v
+        :param peptide_matrix_raw: String peptide matrix file (samples x peptides)
+        :param chunksize: Int number of samples read at a time
+        :return: pandas.Series
+        """
+        reader = pd.read_csv(
+            f"{DPATH}/{peptide_matrix_raw}", sep="\t", index_col=0, chunksize=chunksize
         )
 
-        return idmap
+        sums, counts, pmembership = None, None, None
 
-    def calculate_mean_protein_intensities(
-        self, peptide_matrix_raw="proteomics/E0022_P06_Peptide_Matrix_Raw.tsv.gz"
-    ):
-        peptide_raw = pd.read_csv(
-            f"{DPATH}/{peptide_matrix_raw}", sep="\t", index_col=0
-        ).T
+        for chunk in reader:
+            # Peptide to protein membership matrix (peptides x proteins)
+            if pmembership is None:
+                pcodes, proteins = pd.factorize(
+                    chunk.columns.str.split("=", n=1).str[0]
+                )
+                pmembership = csr_matrix(
+                    (np.ones(len(pcodes)), (np.arange(len(pcodes)), pcodes)),
+                    shape=(len(pcodes), len(proteins)),
+                )
 
-        peptide_raw_mean = (
-            peptide_raw.pipe(np.log2).groupby(self.manifest["SIDM"], axis=1).mean()
-        )
-        peptide_raw_mean = peptide_raw_mean.groupby(
-            [p.split("=")[0] for p in peptide_raw_mean.index]
-        ).mean()
+            chunk = chunk[chunk.index.isin(self.manifest.index)]
+
+            if chunk.shape[0] == 0:
+                continue
+
+            values = np.log2(chunk.values)
+            measured = ~np.isnan(values)
+
+            sids = self.manifest.loc[chunk.index, "SIDM"].values
+
+            c_sums = pd.DataFrame(
+                pmembership.T.dot(np.where(measured, values, 0).T).T,
+                index=sids,
+                columns=proteins,
+            ).groupby(level=0).sum()
+
+            c_counts = pd.DataFrame(
+                pmembership.T.dot(measured.T.astype(float)).T,
+                index=sids,
+                columns=proteins,
+            ).groupby(level=0).sum()
+
+            sums = c_sums if sums is None else sums.add(c_sums, fill_value=0)
+            counts = c_counts if counts is None else counts.add(c_counts, fill_value=0)
+
+        peptide_raw_mean = sums.divide(counts.where(counts > 0)).T
         peptide_raw_mean = peptide_raw_mean.mean(1).sort_values()
 
-        pmap = (
-            self.map_gene_name().reindex(peptide_raw_mean.index)["GeneSymbol"].dropna()
-        )
+        pmap = UniProt().map(peptide_raw_mean.index).dropna()
 
         peptide_raw_mean = peptide_raw_mean[peptide_raw_mean.index.isin(pmap.index)]
         peptide_raw_mean = peptide_raw_mean.groupby(
@@ -921,18 +1597,32 @@ class Proteomics:
     def replicates_correlation(
         self, reps_file="proteomics/E0022_P06_Protein_Matrix_Replicate_ProNorM.tsv.gz"
     ):
-        reps = pd.read_csv(f"{DPATH}/{reps_file}", sep="\t", index_col=0).T
-
-        reps_corr = {}
+        reps = Store.matrix(f"{DPATH}/{reps_file}", sep="\t", index_col=0).T
+
+        # Replicates (columns) of each cell line
+        reps_sidm = self.manifest["SIDM"].reindex(reps.columns).dropna()
+        reps_sidm = pd.DataFrame(
+            dict(
+                sample=reps_sidm.index,
+                SIDM=reps_sidm.values,
+                pos=np.arange(len(reps_sidm)),
+            )
+        )
 
-        for n, df in reps.groupby(self.manifest["SIDM"], axis=1):
-            df_corr = df.corr()
-            df_corr = pd.DataFrame(df_corr.pipe(np.triu, k=1)).replace(0, np.nan)
-            reps_corr[n] = df_corr.unstack().dropna().mean()
+        pairs = reps_sidm.merge(reps_sidm, on="SIDM", suffixes=("_1", "_2"))
+        pairs = pairs.query("pos_1 < pos_2")
 
-        reps_corr = pd.Series(reps_corr, name="RepsCorrelation").sort_values(
-            ascending=False
+        # Mean correlation of replicates pairs
+        reps_corr = Utils.pairs_correlation(
+            reps, pairs=pairs[["sample_1", "sample_2"]].values
         )
+        reps_corr = (
+            reps_corr.groupby(pairs["SIDM"].values)["corr"]
+            .mean()
+            .reindex(reps_sidm["SIDM"].unique())
+        )
+
+        reps_corr = reps_corr.rename("RepsCorrelation").sort_values(ascending=False)
 
         return reps_corr
 
@@ -949,7 +1639,7 @@ class CRISPR:
         institute_file="crispr/CRISPR_Institute_Origin_20191108.csv.gz",
         merged_file="crispr/CRISPRcleanR_FC.txt.gz",
     ):
-        self.crispr = pd.read_csv(f"{DPATH}/{fc_file}", index_col=0)
+        self.crispr = Store.matrix(f"{DPATH}/{fc_file}", index_col=0)
         self.institute = pd.read_csv(
             f"{DPATH}/{institute_file}", index_col=0, header=None
         ).iloc[:, 0]
@@ -962,7 +1652,9 @@ class CRISPR:
             .first()
         )
 
-        self.merged = pd.read_csv(f"{DPATH}/{merged_file}", index_col=0, sep="\t")
+        self.merged = Store.matrix(
+            f"{DPATH}/{merged_file}", index_col=0, sep="\t"
+        )
         self.merged_institute = pd.Series(
             {c: "Broad" if c.startswith("ACH-") else "Sanger" for c in self.merged}
         )
@@ -1068,7 +1760,7 @@ class Mobem:
             .set_index("COSMIC_ID")["model_id"]
         )
 
-        mobem = pd.read_csv(f"{DPATH}/{mobem_file}", index_col=0)
+        mobem = Store.table(f"{DPATH}/{mobem_file}", index_col=0)
         mobem = mobem[mobem.index.astype(str).isin(idmap.index)]
         mobem = mobem.set_index(idmap[mobem.index.astype(str)].values)
 
@@ -1144,13 +1836,13 @@ class CopyNumber:
     ):
         self.ss_obj = Sample()
 
-        self.copynumber = pd.read_csv(f"{DPATH}/{cnv_file}", index_col=0)
+        self.copynumber = Store.matrix(f"{DPATH}/{cnv_file}", index_col=0)
 
         self.ploidy = self.ss_obj.samplesheet["ploidy"]
 
-        self.copynumber_seg = pd.read_csv(f"{DPATH}/{segmentation_file}")
+        self.copynumber_seg = Store.table(f"{DPATH}/{segmentation_file}")
 
-        self.gistic = pd.read_csv(
+        self.gistic = Store.table(
             f"{DPATH}/{gistic_file}", index_col="gene_symbol"
         ).drop(columns=["gene_id"])
 
@@ -1326,7 +2018,9 @@ class Methylation:
     def __init__(
         self, methy_gene_promoter="methylation/methy_beta_gene_promoter.csv.gz"
     ):
-        self.methy_promoter = pd.read_csv(f"{DPATH}/{methy_gene_promoter}", index_col=0)
+        self.methy_promoter = Store.matrix(
+            f"{DPATH}/{methy_gene_promoter}", index_col=0
+        )
 
     def get_data(self):
         return self.methy_promoter.copy()
@@ -1,116 +1,541 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
-import random
 import logging
 import operator
 import numpy as np
 import pandas as pd
 import pkg_resources
 from crispy import CrispyPlot
+from crispy.Store import Store
 import matplotlib.pyplot as plt
+from collections import OrderedDict
+from collections.abc import Mapping
 from matplotlib.gridspec import GridSpec
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
 from scipy.stats.distributions import hypergeom
 from statsmodels.stats.multitest import multipletests
 
 
 dpath = pkg_resources.resource_filename("crispy", "data/")
 
+LOG = logging.getLogger("Crispy")
+
+
+class GeneSets(Mapping):
+    """
+    Compiled gene-sets: gene vocabulary, sparse membership matrix (gene-sets x genes) and gene-set name index.
+
+    GMT files are compiled once and cached to disk next to the GMT file (.npz), the cache is rebuilt if the GMT file
+    changes. Behaves as a read-only dict(gene-set: set of genes).
+    """
+
+    CACHE = {}
+
+    def __init__(self, names, genes, membership):
+        """
+        :param names: list of gene-set names
+        :param genes: list of genes (vocabulary)
+        :param membership: scipy.sparse.csr_matrix boolean (gene-sets x genes) with sorted indices
+        """
+        self.names = np.asarray(names, dtype=str)
+        self.genes = np.asarray(genes, dtype=str)
+        self.membership = membership
+
+        self.names_idx = {n: i for i, n in enumerate(self.names)}
+
+    def __getitem__(self, name):
+        return set(self.genes[self.row(self.names_idx[name])])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names_idx
+
+    def row(self, i):
+        return self.membership.indices[self.membership.indptr[i] : self.membership.indptr[i + 1]]
+
+    def sizes(self):
+        return np.diff(self.membership.indptr)
+
+    def rows(self):
+        return np.split(self.membership.indices, self.membership.indptr[1:-1])
+
+    @classmethod
+    def from_dict(cls, signatures):
+        """
+        :param signatures: dict(str: iterable of genes)
+        :return: GeneSets
+        """
+        genes = [list(signatures[n]) for n in signatures]
+
+        vocabulary = pd.Index(sorted({g for s in genes for g in s}))
+
+        rows = np.repeat(np.arange(len(genes)), [len(s) for s in genes])
+        cols = vocabulary.get_indexer([g for s in genes for g in s])
+
+        membership = csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)),
+            shape=(len(genes), len(vocabulary)),
+        )
+        membership.sort_indices()
+
+        return cls(list(signatures), vocabulary, membership)
+
+    @classmethod
+    def read_gmt(cls, file_path):
+        with open(file_path) as f:
+            signatures = {}
+
+            for l in f:
+                l = l.strip().split("\t")
+                signatures[l[0]] = {g for g in l[2:] if g != ""}
+
+        return cls.from_dict(signatures)
+
+    @classmethod
+    def load(cls, file_path, cache=True):
+        """
+        Load a GMT file, from memory or from the compiled .npz cache if up to date.
+
+        :param file_path: String GMT file path
+        :param cache: Boolean write the compiled .npz cache
+        :return: GeneSets
+        """
+        signature = Store.signature([file_path])
+
+        if file_path in cls.CACHE:
+            if Store.same_signature(cls.CACHE[file_path][0], signature):
+                return cls.CACHE[file_path][1]
+
+        def read(cache_file):
+            with np.load(cache_file) as f:
+                return cls(
+                    f["names"],
+                    f["genes"],
+                    csr_matrix(
+                        (np.ones(len(f["indices"]), dtype=bool), f["indices"], f["indptr"]),
+                        shape=(len(f["names"]), len(f["genes"])),
+                    ),
+                )
+
+        def write(gsets, cache_file):
+            with open(cache_file, "wb") as f:
+                np.savez(
+                    f,
+                    names=gsets.names,
+                    genes=gsets.genes,
+                    indptr=gsets.membership.indptr,
+                    indices=gsets.membership.indices,
+                )
+
+        gsets = Store.cached(
+            f"{file_path}.npz",
+            [file_path],
+            lambda: cls.read_gmt(file_path),
+            read,
+            write,
+            write=cache,
+            name="Gene-sets cache",
+        )
+
+        cls.CACHE[file_path] = (signature, gsets)
+
+        return gsets
+
+    def membership_matrix(self, genes):
+        """
+        Membership matrix over a gene universe, columns follow the order of genes (first occurrence if duplicated).
+
+        :param genes: list of genes
+        :return: scipy.sparse.csr_matrix boolean (gene-sets x genes)
+        """
+        n_genes = len(genes)
+
+        genes = pd.Series(np.arange(n_genes), index=genes)
+        genes = genes[~genes.index.duplicated()]
+
+        vocabulary_pos = genes.reindex(self.genes).fillna(-1).astype(int).values
+
+        cols = vocabulary_pos[self.membership.indices]
+        rows = np.repeat(np.arange(len(self.names)), self.sizes())
+
+        membership = csr_matrix(
+            (np.ones((cols >= 0).sum(), dtype=bool), (rows[cols >= 0], cols[cols >= 0])),
+            shape=(len(self.names), n_genes),
+        )
+        membership.sort_indices()
+
+        return membership
+
+    def take(self, idx):
+        return GeneSets(self.names[idx], self.genes, self.membership[idx])
+
+    def subset(self, genes=None, min_size=None):
+        """
+        Gene-sets restricted to genes, keeping gene-sets with more than min_size genes.
+
+        :return: GeneSets
+        """
+        genes = None if genes is None else list(genes)
+
+        membership = self.membership if genes is None else self.membership_matrix(genes)
+        vocabulary = self.genes if genes is None else genes
+
+        if min_size is not None:
+            keep = np.diff(membership.indptr) > min_size
+            return GeneSets(self.names[keep], vocabulary, membership[keep])
+
+        return GeneSets(self.names, vocabulary, membership)
+
+    def to_dict(self):
+        return {n: set(self.genes[r]) for n, r in zip(self.names, self.rows())}
+
 
 class SSGSEA(object):
+    # Approximate peak memory (bytes) of es_positions per signature gene and score
+    ES_BYTES = 64
+
+    @staticmethod
+    def rank(dataset):
+        """
+        Sort data-set by values, in decreasing order. The ranking can be shared across signatures (gsea_ranked).
+
+        :param dataset: dict or pandas.Series of gene values
+        :return: pandas.Series
+        """
+        dataset = pd.Series(dataset, dtype=float)
+
+        order = np.argsort(-dataset.values, kind="stable")
+
+        return dataset.iloc[order]
+
     @classmethod
-    def gsea(cls, dataset, signature, permutations=0):
-        # Sort data-set by values
-        _dataset = list(
-            zip(*sorted(dataset.items(), key=operator.itemgetter(1), reverse=True))
+    def gsea(cls, dataset, signature, permutations=0, return_hits=False, seed=None):
+        return cls.gsea_ranked(
+            cls.rank(dataset),
+            signature,
+            permutations=permutations,
+            return_hits=return_hits,
+            seed=seed,
         )
-        genes, expression = _dataset[0], _dataset[1]
+
+    @classmethod
+    def gsea_ranked(
+        cls,
+        ranking,
+        signature,
+        permutations=0,
+        return_hits=False,
+        seed=None,
+        null_cache=None,
+    ):
+        """
+        Signature enrichment score (and permutation p-value) on a pre-sorted ranking (SSGSEA.rank).
+
+        :param ranking: pandas.Series sorted in decreasing order
+        :param signature: iterable of genes
+        :param permutations: number of random signatures
+        :param return_hits: Boolean return the hits and running hit arrays (used for plotting)
+        :param seed: int random seed of the permutations
+        :param null_cache: dict of null distributions by signature size, shared across signatures of the ranking
+        :return: e_score, p_value, hits, running_hit
+        """
+        genes, expression = ranking.index, np.abs(ranking.values)
 
         # Signature overlapping the data-set
-        _signature = set(signature).intersection(genes)
+        sig_hits = genes.isin(list(signature))
 
         # Check signature overlap
-        e_score, p_value = np.NaN, np.NaN
+        e_score, p_value = np.nan, np.nan
         hits, running_hit = [], []
-        if len(_signature) != 0:
+        if sig_hits.any():
 
             # ---- Calculate signature enrichment score
-            n, sig_size = len(genes), len(_signature)
-            nh = n - sig_size
-            nr = sum([abs(dataset[g]) for g in _signature])
+            sig_size = sig_hits.sum()
 
-            e_score = cls.__es(
-                genes, expression, _signature, nr, nh, n, hits, running_hit
-            )
+            e_score, r_hit = cls.es(expression, sig_hits, return_running=True)
+
+            if return_hits:
+                hits, running_hit = sig_hits.astype(int), r_hit
 
             # ---- Calculate statistical enrichment
-            # Generate random signatures sampled from the data-set genes
+            # Random signatures sampled from the data-set genes, shared across signatures with the same size
             if permutations > 0:
-                count = 0
+                if null_cache is None:
+                    null_cache = {}
 
-                for i in range(permutations):
-                    r_signature = random.sample(genes, sig_size)
-
-                    r_nr = sum([abs(dataset[g]) for g in r_signature])
-
-                    r_es = cls.__es(genes, expression, r_signature, r_nr, nh, n)
-
-                    if (r_es >= e_score >= 0) or (r_es <= e_score < 0):
-                        count += 1
+                if sig_size not in null_cache:
+                    null_cache[sig_size] = cls.null_es(
+                        expression, sig_size, permutations, seed=seed
+                    )
 
                 # If no permutation was above the Enrichment score the p-value is lower than 1 divided by the number
                 # of permutations
-                p_value = 1 / permutations if count == 0 else count / permutations
+                p_value = Enrichment.one_sided_pvalue(e_score, null_cache[sig_size])
 
             else:
                 p_value = np.nan
 
         return e_score, p_value, hits, running_hit
 
+    @classmethod
+    def gsea_positions(cls, expression, members, permutations=0, seed=None):
+        """
+        Enrichment of multiple signatures given the sorted ranking positions of their genes, sharing the null
+        distributions across signatures with the same size.
+
+        :param expression: numpy.array (n) absolute values sorted in decreasing order
+        :param members: list of numpy.array sorted positions of the genes of each signature
+        :param permutations: number of random signatures
+        :param seed: int random seed of the permutations
+        :return: e_scores, p_values numpy.array (m)
+        """
+        e_scores = np.full(len(members), np.nan)
+        p_values = np.full(len(members), np.nan)
+
+        null_cache = {}
+
+        for i, positions in enumerate(members):
+            if len(positions) == 0:
+                continue
+
+            e_scores[i] = cls.es_positions(expression, positions)
+
+            if permutations > 0:
+                if len(positions) not in null_cache:
+                    null_cache[len(positions)] = cls.null_es(
+                        expression, len(positions), permutations, seed=seed
+                    )
+
+                p_values[i] = Enrichment.one_sided_pvalue(e_scores[i], null_cache[len(positions)])
+
+        return e_scores, p_values
+
+    @classmethod
+    def null_es(cls, expression, sig_size, permutations, seed=None):
+        """
+        Null distribution of enrichment scores of random signatures. Random signatures are generated as a matrix of
+        gene indices (permutations x sig_size) and scored all at once.
+
+        :param expression: numpy.array (n) absolute values sorted in decreasing order
+        :param sig_size: int number of genes per random signature
+        :param permutations: number of random signatures
+        :param seed: int random seed, combined with sig_size so nulls of different sizes are independent
+        :return: numpy.array (permutations)
+        """
+        return cls.es_positions(
+            expression, cls.null_positions(len(expression), sig_size, permutations, seed)
+        )
+
     @staticmethod
-    def __es(genes, expression, signature, nr, nh, n, hits=None, running_hit=None):
-        hit, miss, es, r = 0, 0, 0, 0
-        for i in range(n):
-            if genes[i] in signature:
-                hit += abs(expression[i]) / nr
+    def null_positions(n, sig_size, permutations, seed=None):
+        """
+        Sorted ranking positions of random signatures.
 
-                if hits is not None:
-                    hits.append(1)
+        :return: numpy.array (permutations, sig_size)
+        """
+        rng = np.random.default_rng(None if seed is None else [seed, sig_size])
 
-            else:
-                miss += 1 / nh
+        # Random keys of every gene, the sig_size smallest of each permutation are the random signature genes.
+        # Drawn in chunks of permutations to bound the memory of the (permutations, n) keys.
+        chunk_size = max(1, 2 ** 24 // max(n, 1))
 
-                if hits is not None:
-                    hits.append(0)
+        r_idx = [np.empty((0, sig_size), dtype=int)]
+        for i in range(0, permutations, chunk_size):
+            keys = rng.random((min(chunk_size, permutations - i), n))
+            r_idx.append(np.argpartition(keys, sig_size - 1, axis=1)[:, :sig_size])
+
+        return np.sort(np.concatenate(r_idx), axis=1)
+
+    @staticmethod
+    def es_positions(expression, positions):
+        """
+        Running-sum enrichment score from the sorted positions of the signature genes in the ranking. The running
+        sum is piecewise linear, hence its extremes are either right after a hit (peaks) or right before one
+        (troughs), which only requires cumulative sums over the hits.
+
+        :param expression: numpy.array (n) absolute values sorted in decreasing order, or (..., n) one ranking per
+            row of positions (broadcast)
+        :param positions: numpy.array (k) or (..., k) sorted positions of the signature genes
+        :return: enrichment score(s)
+        """
+        n, k = expression.shape[-1], positions.shape[-1]
+
+        if expression.ndim == 1:
+            w = expression[positions]
+
+        else:
+            w = np.take_along_axis(expression, positions, -1)
 
-            r = hit - miss
+        with np.errstate(divide="ignore", invalid="ignore"):
+            w = w / w.sum(-1, keepdims=True)
+            miss = (positions + 1 - np.arange(1, k + 1)) / (n - k) if n > k else 0
 
-            if running_hit is not None:
-                running_hit.append(r)
+        peaks = np.cumsum(w, axis=-1) - miss
+        troughs = peaks - w
 
-            if abs(r) > abs(es):
-                es = r
+        # Candidates in ranking order, so ties resolve to the first position as in es
+        candidates = np.stack([troughs, peaks], axis=-1).reshape(*peaks.shape[:-1], 2 * k)
+
+        es_idx = np.argmax(np.abs(candidates), axis=-1)
+        es = np.take_along_axis(candidates, np.expand_dims(es_idx, -1), -1)[..., 0][()]
 
         return es
 
+    @staticmethod
+    def rank_matrix(values):
+        """
+        Rank all the samples (columns) at once, in decreasing order.
+
+        :param values: numpy.array (n genes, s samples)
+        :return: sorted absolute values (s, n) and position of each gene in each sample ranking (n, s)
+        """
+        order = np.argsort(-values, axis=0, kind="stable")
+
+        expression = np.abs(np.take_along_axis(values, order, axis=0)).T
+
+        positions = np.empty_like(order)
+        np.put_along_axis(positions, order, np.arange(len(order))[:, None], axis=0)
+
+        return np.ascontiguousarray(expression), positions
+
+    @classmethod
+    def gsea_matrix(
+        cls, expression, positions, members, permutations=0, seed=None, max_memory=2 ** 29
+    ):
+        """
+        Enrichment scores (and permutation p-values and normalised scores) of multiple signatures in multiple samples
+        (SSGSEA.rank_matrix). Signatures are scored in increasing size, so each null distribution is generated once
+        and shared across the signatures with the same size. Scores are normalised by the mean of the null scores
+        with the same sign.
+
+        :param expression: numpy.array (s, n) sorted absolute values of each sample
+        :param positions: numpy.array (n, s) position of each gene in each sample ranking
+        :param members: list of numpy.array gene indices of each signature
+        :param permutations: number of random signatures
+        :param seed: int random seed of the permutations
+        :param max_memory: approximate memory (bytes) of the temporary arrays used to score the samples against the
+            null signatures, which are scored in blocks of samples and permutations
+        :return: e_scores (s, m), p_values (s, m), nes (s, m)
+        """
+        n_samples, n = expression.shape
+
+        e_scores = np.full((n_samples, len(members)), np.nan)
+        p_values = np.full((n_samples, len(members)), np.nan)
+        nes = np.full((n_samples, len(members)), np.nan)
+
+        null_size, null = None, None
+
+        for j in np.argsort([len(i) for i in members], kind="stable"):
+            sig_size = len(members[j])
+
+            if sig_size == 0:
+                continue
+
+            e_scores[:, j] = cls.es_positions(expression, np.sort(positions[members[j]].T, axis=1))
+
+            if permutations > 0:
+                if sig_size != null_size:
+                    r_pos = cls.null_positions(n, sig_size, permutations, seed)[None]
+
+                    # Null scores per block, es_positions holds ~ES_BYTES per signature gene of each null score
+                    block = max(1, max_memory // (cls.ES_BYTES * sig_size))
+                    s_chunk, p_chunk = max(1, block // permutations), min(block, permutations)
+
+                    null_size, null = sig_size, np.concatenate(
+                        [
+                            np.concatenate(
+                                [
+                                    cls.es_positions(
+                                        expression[i : i + s_chunk, None],
+                                        r_pos[:, p : p + p_chunk],
+                                    )
+                                    for p in range(0, permutations, p_chunk)
+                                ],
+                                axis=1,
+                            )
+                            for i in range(0, n_samples, s_chunk)
+                        ]
+                    )
+
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        null_pos = (null * (null >= 0)).sum(1) / (null >= 0).sum(1)
+                        null_neg = -(null * (null < 0)).sum(1) / (null < 0).sum(1)
+
+                # One-sided p-values, as Enrichment.one_sided_pvalue
+                es = e_scores[:, [j]]
+                count = np.where(es >= 0, null >= es, null <= es).sum(1)
+                p_values[:, j] = np.maximum(count, 1) / permutations
+
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    nes[:, j] = es[:, 0] / np.where(es[:, 0] >= 0, null_pos, null_neg)
+
+        return e_scores, p_values, nes
+
+    @staticmethod
+    def es(expression, hits, return_running=False):
+        """
+        Running-sum enrichment score, i.e. the maximum deviation from zero of the running sum.
+
+        :param expression: numpy.array (n) absolute values sorted in decreasing order
+        :param hits: numpy.array boolean (n) or (k, n) signature membership of each ranked gene
+        :param return_running: Boolean return also the running sum
+        :return: enrichment score(s) (and running sum(s))
+        """
+        nr = (expression * hits).sum(-1, keepdims=True)
+        nh = hits.shape[-1] - hits.sum(-1, keepdims=True)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            running_hit = np.cumsum(np.where(hits, expression / nr, -1 / nh), axis=-1)
+
+        es_idx = np.argmax(np.abs(running_hit), axis=-1)
+        es = np.take_along_axis(running_hit, np.expand_dims(es_idx, -1), -1)[..., 0][()]
+
+        return (es, running_hit) if return_running else es
+
 
 class Enrichment:
     """
     Gene enrichment analysis class.
 
+    max_memory bounds the temporary arrays (bytes) of the permutation tests of gsea_matrix in each process.
+
     """
 
     def __init__(
-        self, gmts, sig_min_len=5, verbose=0, padj_method="fdr_bh", permutations=0
+        self,
+        gmts,
+        sig_min_len=5,
+        verbose=0,
+        padj_method="fdr_bh",
+        permutations=0,
+        seed=None,
+        n_jobs=1,
+        max_memory=2 ** 29,
+        members_cache_size=16,
     ):
 
         self.verbose = verbose
         self.padj_method = padj_method
         self.permutations = permutations
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.max_memory = max_memory
 
         self.sig_min_len = sig_min_len
 
-        self.gmts = {f: self.read_gmt(f"{dpath}/pathways/{f}") for f in gmts}
+        self.members_cache_size = members_cache_size
+        self.members_cache = OrderedDict()
+
+        self.gmts = {
+            f: GeneSets.load(f"{dpath}/pathways/{f}").subset(min_size=15) for f in gmts
+        }
 
     def __assert_gmt_file(self, gmt_file):
         assert gmt_file in self.gmts, f"{gmt_file} not in gmt files: {self.gmts.keys()}"
@@ -121,25 +546,11 @@ class Enrichment:
 
     @staticmethod
     def read_gmt(file_path, subset=None, min_size=15):
-        with open(file_path) as f:
-            signatures = {}
-
-            for l in f.readlines():
-                sig_name = l.split("\t")[0]
-
-                sig_genes = set(l.strip().split("\t")[2:])
-
-                if subset is not None:
-                    sig_genes = sig_genes.intersection(subset)
-
-                if len(sig_genes) > min_size:
-                    signatures[sig_name] = sig_genes
-
-        return signatures
+        return GeneSets.load(file_path).subset(genes=subset, min_size=min_size).to_dict()
 
     @classmethod
     def read_signature(cls, gmt_file, signature):
-        return cls.read_gmt(gmt_file)[signature]
+        return GeneSets.load(gmt_file)[signature]
 
     @classmethod
     def signature(cls, signature):
@@ -161,48 +572,176 @@ class Enrichment:
         else:
             gs_file = "c5.all.v7.1.symbols.gmt"
 
-        return cls.read_gmt(f"{dpath}/pathways/{gs_file}")[signature]
+        return GeneSets.load(f"{dpath}/pathways/{gs_file}")[signature]
 
-    def gsea(self, values, signature):
-        return SSGSEA.gsea(values.to_dict(), signature, permutations=self.permutations)
+    def gsea(self, values, signature, return_hits=False):
+        return SSGSEA.gsea(
+            values,
+            signature,
+            permutations=self.permutations,
+            return_hits=return_hits,
+            seed=self.seed,
+        )
 
     def gsea_enrichments(self, values):
+        gmt_files = list(self.gmts)
+        res = self.session(values).gsea_enrichments(gmt_files)
+
         return pd.concat(
-            [self.gsea_enrichment(values, gmt_file=g).assign(gmt=g) for g in self.gmts]
+            [df.assign(gmt=g) for g, df in zip(gmt_files, res)]
         ).sort_values("e_score")
 
     def gsea_enrichment(self, values, gmt_file):
+        return self.session(values).gsea_enrichment(gmt_file)
+
+    def session(self, values):
+        return EnrichmentSession(self, values)
+
+    def universe_members(self, genes, gmt_file):
+        """
+        Membership matrix of the gene-sets of gmt_file over genes. LRU cached by gene universe (members_cache_size
+        entries), so repeated analyses on the same genes only compute the overlaps once.
+
+        :param genes: pandas.Index
+        :param gmt_file: String GMT file
+        :return: scipy.sparse.csr_matrix boolean (gene-sets x genes)
+        """
         self.__assert_gmt_file(gmt_file)
 
-        geneset = self.gmts[gmt_file]
+        key = (gmt_file, hash(tuple(genes)))
 
-        if self.verbose > 0 and type(values) == pd.Series:
-            logging.getLogger("DTrace").info(f"Values={values.name}")
+        if key in self.members_cache and self.members_cache[key][0].equals(genes):
+            self.members_cache.move_to_end(key)
+
+        else:
+            self.members_cache[key] = (
+                genes,
+                self.gmts[gmt_file].membership_matrix(genes),
+            )
+            self.members_cache.move_to_end(key)
 
-        ssgsea = []
-        for gset in geneset:
-            if self.verbose > 1:
-                logging.getLogger("DTrace").info(f"Gene-set={gset}")
+            if len(self.members_cache) > self.members_cache_size:
+                self.members_cache.popitem(last=False)
+
+        return self.members_cache[key][1]
+
+    def gsea_matrix(self, df, gmt_file):
+        """
+        Enrichment of the gene-sets of gmt_file in every sample of a matrix. Missing values are handled per sample:
+        samples are grouped by their measured genes and each group is ranked over its own genes. Gene-sets are
+        split across n_jobs by size, so that chunks share null distributions.
+
+        :param df: pandas.DataFrame genes x samples
+        :param gmt_file: String GMT file
+        :return: e_scores, p_values, nes pandas.DataFrame samples x gene-sets (p-values and normalised scores are
+            NaN if permutations=0, or if the gene-set is too small in the measured genes of a sample)
+        """
+        return self.gsea_matrices([(df, gmt_file)])[0]
+
+    def gsea_matrices(self, jobs):
+        """
+        Enrichment of several matrices and/or GMT files (see gsea_matrix). All jobs share a single pool of n_jobs
+        processes.
+
+        :param jobs: list of (pandas.DataFrame genes x samples, String GMT file)
+        :return: list of (e_scores, p_values, nes), one per job
+        """
+        for _, gmt_file in jobs:
+            self.__assert_gmt_file(gmt_file)
 
-            gset_len = len({i for i in geneset[gset] if i in values.index})
+        tasks = [self.gsea_matrix_tasks(df, gmt_file) for df, gmt_file in jobs]
+        args = [a for t in tasks for _, _, a in t]
 
-            e_score, p_value, _, _ = self.gsea(values, geneset[gset])
+        if self.n_jobs == 1 or len(args) == 1:
+            res = [SSGSEA.gsea_matrix(*a) for a in args]
 
-            ssgsea.append(
-                dict(gset=gset, e_score=e_score, p_value=p_value, len=gset_len)
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                futures = [executor.submit(SSGSEA.gsea_matrix, *a) for a in args]
+                res = [f.result() for f in futures]
+
+        res_jobs = []
+        for (df, gmt_file), t in zip(jobs, tasks):
+            res_jobs.append(self.gsea_matrix_collect(df, gmt_file, t, res[: len(t)]))
+            res = res[len(t) :]
+
+        return res_jobs
+
+    def gsea_matrix_tasks(self, df, gmt_file):
+        """
+        Split the enrichment of a matrix in SSGSEA.gsea_matrix calls, one per group of samples with the same
+        measured genes and chunk of gene-sets (sorted by size).
+
+        :param df: pandas.DataFrame genes x samples
+        :param gmt_file: String GMT file
+        :return: list of (samples indices, gene-sets indices, SSGSEA.gsea_matrix arguments)
+        """
+        measured = df.notna().values
+
+        groups = {}
+        for i, key in enumerate(np.packbits(measured, axis=0).T):
+            groups.setdefault(key.tobytes(), []).append(i)
+
+        if len(groups) > 1:
+            LOG.info(f"{gmt_file}: {len(groups)} groups of samples with missing genes")
+
+        tasks = []
+        for samples in groups.values():
+            genes = measured[:, samples[0]]
+
+            # Rank all samples of the group at once
+            expression, positions = SSGSEA.rank_matrix(
+                df.values[np.ix_(genes, samples)]
             )
 
-        ssgsea = pd.DataFrame(ssgsea).set_index("gset").sort_values("e_score")
+            # Signatures genes indices
+            membership = self.universe_members(df.index[genes], gmt_file)
+            members = np.split(membership.indices, membership.indptr[1:-1])
 
-        if self.sig_min_len is not None:
-            ssgsea = ssgsea.query(f"len >= {self.sig_min_len}")
+            gsets_len = np.diff(membership.indptr)
+            gsets_idx = np.arange(len(gsets_len))
 
-        if self.permutations > 0:
-            ssgsea["adj.p_value"] = multipletests(
-                ssgsea["p_value"], method=self.padj_method
-            )[1]
+            if self.sig_min_len is not None:
+                gsets_idx = gsets_idx[gsets_len >= self.sig_min_len]
 
-        return ssgsea
+            gsets_idx = gsets_idx[np.argsort(gsets_len[gsets_idx], kind="stable")]
+
+            for c in np.array_split(gsets_idx, self.n_jobs):
+                if len(c) > 0:
+                    args = (
+                        expression,
+                        positions,
+                        [members[i] for i in c],
+                        self.permutations,
+                        self.seed,
+                        self.max_memory,
+                    )
+                    tasks.append((samples, c, args))
+
+        return tasks
+
+    def gsea_matrix_collect(self, df, gmt_file, tasks, res):
+        """
+        Gather the SSGSEA.gsea_matrix results of gsea_matrix_tasks in samples x gene-sets data-frames. Gene-sets
+        not tested in any sample are removed.
+
+        :return: e_scores, p_values, nes pandas.DataFrame samples x gene-sets
+        """
+        gsets = self.gmts[gmt_file].names
+
+        scores = [np.full((df.shape[1], len(gsets)), np.nan) for _ in range(3)]
+        tested = np.zeros(len(gsets), dtype=bool)
+
+        for (samples, c, _), r in zip(tasks, res):
+            for m, v in zip(scores, r):
+                m[np.ix_(samples, c)] = v
+
+            tested[c] = True
+
+        return tuple(
+            pd.DataFrame(m[:, tested], index=df.columns, columns=gsets[tested])
+            for m in scores
+        )
 
     def get_signature(self, gmt_file, signature):
         self.__assert_signature(gmt_file, signature)
@@ -212,7 +751,7 @@ class Enrichment:
         if type(signature) == str:
             gset = self.get_signature(gmt_file, signature)
 
-        e_score, p_value, hits, running_hit = self.gsea(values, gset)
+        e_score, p_value, hits, running_hit = self.gsea(values, gset, return_hits=True)
 
         ax = GSEAplot.plot_gsea(
             hits,
@@ -254,37 +793,60 @@ class Enrichment:
         return pvalue, intersection
 
     def hypergeom_enrichments(self, sublist, background, gmt_file):
+        """
+        Hypergeometric over-representation of the gene-sets of gmt_file in one or multiple sublists. Intersections
+        of all the gene-sets are obtained at once with a sparse matrix product.
+
+        :param sublist: set of genes, or dict(str: set) of sublists scored at once
+        :param background: set of genes
+        :param gmt_file: String GMT file
+        :return: pandas.DataFrame (with a sublist column if multiple sublists are provided)
+        """
         self.__assert_gmt_file(gmt_file)
 
         geneset = self.gmts[gmt_file]
 
-        ssgsea_geneset = []
-        for gset in geneset:
-            if self.verbose > 0:
-                logging.getLogger("DTrace").info(f"Gene-set={gset}")
+        sublists = sublist if isinstance(sublist, dict) else {None: sublist}
 
-            p_value, intersection = self.hypergeom_test(
-                signature=geneset[gset], background=background, sublist=sublist
-            )
+        # Gene universe and indicator vectors of the background and of the sublists
+        universe = pd.Index(set(background).union(*sublists.values()))
 
-            if intersection >= self.sig_min_len:
-                ssgsea_geneset.append(
-                    dict(
-                        gset=gset,
-                        p_value=p_value,
-                        len_sig=len(geneset[gset]),
-                        len_intersection=intersection,
-                    )
-                )
+        background_ind = universe.isin(list(background)).astype(np.int32)
+        sublists_ind = np.stack(
+            [universe.isin(list(sublists[s])) for s in sublists], axis=1
+        ).astype(np.int32)
+
+        membership = geneset.membership_matrix(universe).astype(np.int32)
+
+        # Intersections of the gene-sets with the background and the sublists
+        len_background = membership @ background_ind
+        len_intersection = membership @ sublists_ind
 
-        ssgsea_geneset = (
-            pd.DataFrame(ssgsea_geneset).set_index("gset").sort_values("p_value")
+        p_values = hypergeom.sf(
+            len_intersection,
+            background_ind.sum(),
+            len_background[:, None],
+            sublists_ind.sum(0)[None, :],
         )
-        ssgsea_geneset["adj.p_value"] = multipletests(
-            ssgsea_geneset["p_value"], method=self.padj_method
-        )[1]
 
-        return ssgsea_geneset
+        ssgsea_geneset = []
+        for i, s in enumerate(sublists):
+            keep = len_intersection[:, i] >= self.sig_min_len
+
+            df = pd.DataFrame(
+                dict(
+                    gset=geneset.names[keep],
+                    p_value=p_values[keep, i],
+                    len_sig=geneset.sizes()[keep],
+                    len_intersection=len_intersection[keep, i],
+                )
+            )
+            df = df.set_index("gset").sort_values("p_value")
+            df["adj.p_value"] = multipletests(df["p_value"], method=self.padj_method)[1]
+
+            ssgsea_geneset.append(df if s is None else df.assign(sublist=s))
+
+        return pd.concat(ssgsea_geneset)
 
     @staticmethod
     def one_sided_pvalue(escore, escores):
@@ -295,6 +857,129 @@ class Enrichment:
         return p_value
 
 
+class EnrichmentSession:
+    """
+    Gene-set enrichment of one vector of values: the values are ranked once and the gene-sets overlaps with the gene
+    universe are reused from the Enrichment cache (Enrichment.universe_members).
+    """
+
+    def __init__(self, enrichment, values):
+        """
+        :param enrichment: Enrichment
+        :param values: pandas.Series of gene values
+        """
+        self.enrichment = enrichment
+        self.values = pd.Series(values, dtype=float)
+
+        if enrichment.verbose > 0 and type(values) == pd.Series:
+            logging.getLogger("DTrace").info(f"Values={values.name}")
+
+        # Rank once for all the signatures
+        order = np.argsort(-self.values.values, kind="stable")
+
+        self.expression = np.abs(self.values.values[order])
+
+        # Position of each gene (values index) in the ranking
+        self.positions = np.empty(len(order), dtype=int)
+        self.positions[order] = np.arange(len(order))
+
+    def members(self, gmt_file):
+        """
+        Sorted ranking positions of the genes of each gene-set of gmt_file.
+
+        :return: list of numpy.array
+        """
+        membership = self.enrichment.universe_members(self.values.index, gmt_file)
+
+        rows = np.repeat(np.arange(membership.shape[0]), np.diff(membership.indptr))
+
+        positions = self.positions[membership.indices]
+        positions = positions[np.lexsort((positions, rows))]
+
+        return np.split(positions, membership.indptr[1:-1])
+
+    def gsea_enrichment(self, gmt_file):
+        return self.gsea_enrichments([gmt_file])[0]
+
+    def gsea_enrichments(self, gmt_files):
+        """
+        Enrichment of the gene-sets of several GMT files. All GMT files share a single pool of n_jobs processes.
+
+        :param gmt_files: list of GMT files
+        :return: list of pandas.DataFrame, one per GMT file
+        """
+        enr = self.enrichment
+
+        members = [self.members(g) for g in gmt_files]
+
+        if enr.n_jobs == 1:
+            res = [
+                SSGSEA.gsea_positions(
+                    self.expression, m, permutations=enr.permutations, seed=enr.seed
+                )
+                for m in members
+            ]
+
+        else:
+            # Signatures sorted by size, so that chunks share most null distributions
+            chunks = [
+                np.array_split(np.argsort([len(i) for i in m], kind="stable"), enr.n_jobs)
+                for m in members
+            ]
+
+            with ProcessPoolExecutor(max_workers=enr.n_jobs) as executor:
+                futures = [
+                    [
+                        executor.submit(
+                            SSGSEA.gsea_positions,
+                            self.expression,
+                            [m[i] for i in c],
+                            enr.permutations,
+                            enr.seed,
+                        )
+                        for c in m_chunks
+                    ]
+                    for m, m_chunks in zip(members, chunks)
+                ]
+
+                res = []
+                for m, m_chunks, m_futures in zip(members, chunks, futures):
+                    e_scores, p_values = np.full(len(m), np.nan), np.full(len(m), np.nan)
+
+                    for c, f in zip(m_chunks, m_futures):
+                        e_scores[c], p_values[c] = f.result()
+
+                    res.append((e_scores, p_values))
+
+        return [
+            self.__gsea_table(g, m, e_scores, p_values)
+            for g, m, (e_scores, p_values) in zip(gmt_files, members, res)
+        ]
+
+    def __gsea_table(self, gmt_file, members, e_scores, p_values):
+        enr = self.enrichment
+
+        ssgsea = pd.DataFrame(
+            dict(
+                gset=enr.gmts[gmt_file].names,
+                e_score=e_scores,
+                p_value=p_values,
+                len=[len(i) for i in members],
+            )
+        )
+        ssgsea = ssgsea.set_index("gset").sort_values("e_score")
+
+        if enr.sig_min_len is not None:
+            ssgsea = ssgsea.query(f"len >= {enr.sig_min_len}")
+
+        if enr.permutations > 0:
+            ssgsea["adj.p_value"] = multipletests(
+                ssgsea["p_value"], method=enr.padj_method
+            )[1]
+
+        return ssgsea
+
+
 class GSEAplot(CrispyPlot):
     @classmethod
     def plot_gsea(
@@ -1,18 +1,37 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
+import os
+import time
 import logging
 import numpy as np
+from collections import OrderedDict
 import pandas as pd
-from scipy.stats import chi2
-from sklearn.preprocessing import StandardScaler
+from crispy.Store import Store
+from scipy.stats import chi2, rankdata
+from scipy.linalg import solve_triangular
+from scipy.optimize import minimize_scalar
 from sklearn.linear_model import LinearRegression
 from statsmodels.stats.multitest import multipletests
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 LOG = logging.getLogger("Crispy")
 
 
+# Process pool workers hold a single copy of the LMModels instance, set once at start-up
+_LMM_WORKER = None
+
+
+def _lmm_worker_init(lmm_obj):
+    global _LMM_WORKER
+    _LMM_WORKER = lmm_obj
+
+
+def _lmm_worker(y_vars):
+    return [(y_var, _LMM_WORKER.lmm(y_var=y_var)) for y_var in y_vars]
+
+
 class LModel:
     def __init__(
         self,
@@ -133,7 +152,7 @@ class LModel:
                 dict(
                     y_id=y.columns,
                     x_id=x_var,
-                    n=y.attrs["nan_mask"].loc[y.columns, x.index].sum(1) if "nan_mask" in y.attrs else len(x),
+                    n=LMModels.nan_mask(y).loc[x.index, y.columns].sum(0).values if "nan_mask" in y.attrs else len(x),
                     beta=lm_full.coef_[:, -1],
                     lr=lr.values,
                     covs=m.shape[1],
@@ -150,28 +169,181 @@ class LModel:
 
     @staticmethod
     def lm_residuals(y, x, fit_intercept=True, add_intercept=False):
-        # Prepare input matrices
-        ys = y.dropna()
+        residuals = LModel.lm_residuals_matrix(
+            y.to_frame(), x, fit_intercept=fit_intercept, add_intercept=add_intercept
+        ).iloc[:, 0]
 
-        xs = x.loc[ys.index].dropna()
-        xs = xs.loc[:, xs.std() > 0]
+        if residuals.isna().all():
+            return None
 
-        ys = ys.loc[xs.index]
+        return residuals.dropna()
 
-        if ys.shape[0] <= xs.shape[1]:
-            return None
+    @staticmethod
+    def lm_residuals_matrix(y, x, fit_intercept=True, add_intercept=False):
+        """
+        Residuals of the linear regression of each column of y on the covariates x, as in lm_residuals but for all
+        columns at once. Columns are grouped by missing values pattern and each group is solved with a single
+        factorisation of its covariates matrix. Covariates with no variance within a group are removed.
+
+        :param y: pandas.DataFrame samples x features
+        :param x: pandas.DataFrame samples x covariates
+        :return: pandas.DataFrame samples x features, NaN for samples not used or if samples <= covariates
+        """
+        x = x.reindex(y.index)
+        x_values = x.values.astype(np.float64)
+        y_values = y.values.astype(np.float64)
+
+        residuals = np.full(y_values.shape, np.nan)
+
+        # Samples used by each feature and features grouped by pattern
+        mask = ~np.isnan(y_values) & ~np.isnan(x_values).any(axis=1)[:, None]
+        patterns, patterns_idx = np.unique(
+            np.packbits(mask, axis=0).T, axis=0, return_inverse=True
+        )
+
+        for i in range(len(patterns)):
+            features = np.flatnonzero(patterns_idx.ravel() == i)
+            samples = mask[:, features[0]]
+
+            xs = x_values[samples]
+            xs = xs[:, np.std(xs, axis=0) > 0] if xs.shape[0] > 1 else xs[:, []]
+            ys = y_values[np.ix_(samples, features)]
+
+            if ys.shape[0] <= xs.shape[1]:
+                continue
+
+            # Centre for the intercept, as sklearn LinearRegression
+            if fit_intercept:
+                xs_mean, ys_mean = xs.mean(0), ys.mean(0)
+                xs, ys = xs - xs_mean, ys - ys_mean
+
+            q, r = np.linalg.qr(xs)
+
+            if xs.shape[1] == 0 or np.abs(np.diag(r)).min() > 1e-10 * np.abs(np.diag(r)).max():
+                coef = solve_triangular(r, q.T @ ys) if xs.shape[1] > 0 else np.zeros((0, ys.shape[1]))
+
+            else:
+                # Rank deficient, minimum norm solution
+                coef = np.linalg.lstsq(xs, ys, rcond=None)[0]
 
-        # Linear regression models
-        lm = LinearRegression(fit_intercept=fit_intercept).fit(xs, ys)
+            res = ys - xs @ coef
 
-        # Calculate residuals
-        residuals = ys - lm.predict(xs) - lm.intercept_
+            # Residuals are centred on minus the intercept, unless it is added back
+            if fit_intercept and not add_intercept:
+                res -= ys_mean - xs_mean @ coef
 
-        # Add intercept
-        if add_intercept:
-            residuals += lm.intercept_
+            residuals[np.ix_(samples, features)] = res
 
-        return residuals
+        return pd.DataFrame(residuals, index=y.index, columns=y.columns)
+
+
+class FastLMM:
+    """
+    Linear mixed model with a single random effect (FaST-LMM, Lippert et al. 2011), fitted by maximum likelihood:
+
+        y = M * a + x * b + e, e ~ N(0, s * (K + delta * I))
+
+    K is rotated by its eigendecomposition, delta is estimated once on the null model (covariates only) and kept
+    fixed while all candidate features are tested with batched rotated ordinary least squares.
+    """
+
+    def __init__(self, y, m, qs, log_delta_bounds=(-10, 10), log_delta_grid=100):
+        """
+        :param y: numpy.array (n, 1)
+        :param m: numpy.array (n, c) covariates
+        :param qs: ((Q0, Q1), S0) eigendecomposition of K, as in LMModels.economic_qs
+        """
+        (q0, q1), s0 = qs
+
+        self.n = y.shape[0]
+        self.s = np.concatenate([s0, np.zeros(q1.shape[1])])
+        self.u = np.concatenate([q0, q1], axis=1)
+
+        # Rotated data
+        self.y = self.u.T @ y.reshape(-1, 1)
+        self.m = self.u.T @ m
+
+        self.log_delta_bounds = log_delta_bounds
+        self.log_delta_grid = log_delta_grid
+
+        self.delta = None
+
+    def __residuals(self, delta):
+        """
+        Residuals of the weighted covariates model (covariates projected out) for a given delta.
+
+        :return: (weights, Q of the weighted covariates, weighted residuals of y)
+        """
+        w = 1 / np.sqrt(self.s + delta)
+
+        m_q, _ = np.linalg.qr(self.m * w[:, None])
+
+        y_w = self.y * w[:, None]
+        y_r = y_w - m_q @ (m_q.T @ y_w)
+
+        return w, m_q, y_r
+
+    def __lml(self, rss, delta):
+        return -0.5 * (
+            self.n * np.log(2 * np.pi * rss / self.n)
+            + np.log(self.s + delta).sum()
+            + self.n
+        )
+
+    def null_lml(self, log_delta):
+        delta = np.exp(log_delta)
+        _, _, y_r = self.__residuals(delta)
+        return self.__lml((y_r ** 2).sum(), delta)
+
+    def fit(self):
+        """
+        Estimate delta on the null model with a grid search followed by a bounded Brent refinement.
+        """
+        grid = np.linspace(*self.log_delta_bounds, self.log_delta_grid)
+        grid_lml = np.array([self.null_lml(i) for i in grid])
+
+        step = grid[1] - grid[0]
+        best = grid[np.argmax(grid_lml)]
+
+        opt = minimize_scalar(
+            lambda v: -self.null_lml(v),
+            bounds=(max(best - step, grid[0]), min(best + step, grid[-1])),
+            method="bounded",
+        )
+
+        self.delta = np.exp(opt.x if -opt.fun > grid_lml.max() else best)
+
+        return self
+
+    def scan(self, x):
+        """
+        Likelihood-ratio test of each column of x added to the null model, keeping delta fixed and re-estimating
+        the scale. Columns are tested at once, using the covariates-projected residuals (Frisch-Waugh-Lovell).
+
+        :param x: numpy.array (n, p) candidate features
+        :return: (beta, beta_se, pval) arrays of size p
+        """
+        if self.delta is None:
+            self.fit()
+
+        w, m_q, y_r = self.__residuals(self.delta)
+
+        x_w = (self.u.T @ x) * w[:, None]
+        x_r = x_w - m_q @ (m_q.T @ x_w)
+
+        xx = (x_r ** 2).sum(0)
+        xy = (x_r * y_r).sum(0)
+
+        rss0 = (y_r ** 2).sum()
+        rss1 = rss0 - xy ** 2 / xx
+
+        beta = xy / xx
+        beta_se = np.sqrt(rss1 / self.n / xx)
+
+        lr = 2 * (self.__lml(rss1, self.delta) - self.__lml(rss0, self.delta))
+        pval = chi2(1).sf(np.clip(lr, 0, None))
+
+        return beta, beta_se, pval
 
 
 class LMModels:
@@ -179,6 +351,11 @@ class LMModels:
     Class to perform the linear regression models
     """ ""
 
+    BACKENDS = ["limix", "numpy"]
+
+    # NaN-aware versions of the reductions used to fill missing values (transform_matrix)
+    NAN_REDUCTIONS = {np.mean: np.nanmean, np.median: np.nanmedian}
+
     RES_ORDER = [
         "y_id",
         "x_id",
@@ -206,10 +383,18 @@ class LMModels:
         transform_m2="scale",
         x_min_events=None,
         institute=True,
+        k_cache_size=8,
+        backend="limix",
         verbose=1,
     ):
+        assert backend in self.BACKENDS, f"Backend {backend} not supported"
+        assert (
+            backend != "numpy" or lik == "normal"
+        ), f"Backend {backend} only supports lik=normal"
+
         # Misc
         self.verbose = verbose
+        self.backend = backend
         self.x_feature_type = x_feature_type
         self.m2_feature_type = m2_feature_type
         self.add_intercept = add_intercept
@@ -227,16 +412,12 @@ class LMModels:
         self.k = self.kinship(x) if k is None else k.copy()
         self.m = self.define_covariates(institute=institute) if m is None else m.copy()
 
-        # Samples overlap
-        self.samples = list(
-            set.intersection(
-                set(y.index),
-                set(x.index),
-                set(self.m.index),
-                set(self.k.index),
-                set(y.index) if m2 is None else set(m2.index),
-            )
-        )
+        # Samples overlap, following the order of y
+        samples = y.index
+        for idx in [x.index, self.m.index, self.k.index] + ([] if m2 is None else [m2.index]):
+            samples = samples.intersection(idx, sort=False)
+
+        self.samples = list(samples)
         LOG.info(f"Samples: {len(self.samples)}")
 
         # Y matrix
@@ -247,10 +428,15 @@ class LMModels:
 
         # Covariates
         self.m = self.m.loc[self.samples, self.m.std() > 0]
-        self.m, self.m_columns = self.m.values, np.array(list(self.m.columns))
+        self.m, self.m_columns = self.as_array(self.m), np.array(list(self.m.columns))
 
         # Random effects matrix
-        self.k = self.k.loc[self.samples, self.samples].values
+        self.k = self.as_array(self.k.loc[self.samples, self.samples])
+
+        # Eigendecomposition of the random effects matrix and standard deviation filters per sample mask
+        self.k_cache_size = k_cache_size
+        self.k_qs_cache = OrderedDict()
+        self.std_cache = OrderedDict()
 
         LOG.info(
             f"Y: {self.y.shape[1]}; X: {self.x.shape[1]}; M: {self.m.shape[1]}; K: {self.k.shape[1]}"
@@ -264,6 +450,15 @@ class LMModels:
         else:
             self.m2, self.m2_columns = None, None
 
+        # Columns positions
+        self.y_pos = {v: i for i, v in enumerate(self.y_columns)}
+        self.x_pos = {v: i for i, v in enumerate(self.x_columns)}
+        self.m2_pos = {} if m2 is None else {v: i for i, v in enumerate(self.m2_columns)}
+
+    @staticmethod
+    def as_array(df):
+        return np.ascontiguousarray(df.values, dtype=np.float64)
+
     def __build_y(self, y):
         """
         Method to build the y matrix.
@@ -272,7 +467,7 @@ class LMModels:
         :return:
         """
         y_ = self.transform_matrix(y.loc[self.samples], t_type=self.transform_y)
-        return y_.values, np.array(list(y_.columns))
+        return self.as_array(y_), np.array(list(y_.columns))
 
     def __build_m2(self, m2):
         """
@@ -281,7 +476,7 @@ class LMModels:
         :return:
         """
         m2_ = self.transform_matrix(m2.loc[self.samples], t_type=self.transform_m2)
-        return m2_.values, np.array(list(m2_.columns))
+        return self.as_array(m2_), np.array(list(m2_.columns))
 
     def __build_x(self, x):
         """
@@ -296,56 +491,129 @@ class LMModels:
         else:
             x_ = self.transform_matrix(x_, t_type=self.transform_x)
 
-        return x_.values, np.array(list(x_.columns))
+        return self.as_array(x_), np.array(list(x_.columns))
 
     def __prepare_inputs__(self, y_var):
         # Define samples with NaNs
-        y_idx = list(self.y_columns).index(y_var)
+        y_idx = self.y_pos[y_var]
         y_nans_idx = np.isnan(self.y[:, y_idx])
 
         if self.verbose > 0:
             LOG.info(f"y_id: {y_var} ({y_idx}); N samples: {sum(1 - y_nans_idx)}")
 
+        # Rows of the samples without NaNs (no copy if all samples are kept)
+        rows = slice(None) if not y_nans_idx.any() else np.flatnonzero(~y_nans_idx)
+        x_std, m_std = self.std_filters(~y_nans_idx)
+
         # Remove NaNs from y
-        y_ = self.y[y_nans_idx == 0][:, [y_idx]]
+        y_ = self.y[rows, y_idx].reshape(-1, 1)
 
         # Subset X
-        x_ = self.x[y_nans_idx == 0]
-
         if self.x_feature_type == "drop_y":
-            if y_var not in self.x_columns:
+            if y_var not in self.x_pos:
                 LOG.warning(f"[x_feature_type=drop_y] Y feature {y_idx} not in X")
 
-            x_ = x_[:, self.x_columns != y_var]
-            x_vars = self.x_columns[self.x_columns != y_var]
+            x_cols = np.delete(np.arange(len(self.x_columns)), self.x_pos.get(y_var, []))
 
         elif self.x_feature_type == "same_y":
-            if y_var not in self.x_columns:
+            if y_var not in self.x_pos:
                 LOG.error(f"[x_feature_type=same_y] Y feature {y_idx} not in X")
 
-            x_ = x_[:, self.x_columns == y_var]
-            x_vars = self.x_columns[self.x_columns == y_var]
+            x_cols = np.array([self.x_pos[y_var]] if y_var in self.x_pos else [], dtype=int)
 
         else:
-            x_vars = self.x_columns[np.std(x_, axis=0) > 0]
-            x_ = x_[:, np.std(x_, axis=0) > 0]
+            x_cols = x_std
+
+        x_ = self.x[rows][:, x_cols] if type(rows) is slice else self.x[np.ix_(rows, x_cols)]
+        x_vars = self.x_columns[x_cols]
 
         # Subset m
-        m_ = self.m[y_nans_idx == 0]
-        m_ = m_[:, np.std(m_, axis=0) > 0]
+        m_ = self.m[rows][:, m_std] if type(rows) is slice else self.m[np.ix_(rows, m_std)]
 
         if (self.m2 is not None) and (self.m2_feature_type == "same_y"):
-            m_ = np.append(
-                m_, self.m2[y_nans_idx == 0][:, self.m2_columns == y_var], axis=1
-            )
+            m2_cols = [self.m2_pos[y_var]] if y_var in self.m2_pos else []
+            m_ = np.append(m_, self.m2[rows][:, m2_cols], axis=1)
 
         if self.add_intercept:
             m_ = np.insert(m_, m_.shape[1], values=1, axis=1)
 
-        # Subset random effects matrix
-        k_ = self.k[:, y_nans_idx == 0][y_nans_idx == 0, :]
+        return y_, y_nans_idx, x_, x_vars, m_
+
+    def __mask_cached(self, cache, samples_mask, func):
+        """
+        LRU cache of func(samples_mask), keyed by the packed sample mask.
+        """
+        key = np.packbits(samples_mask).tobytes()
+
+        if key in cache:
+            cache.move_to_end(key)
+
+        else:
+            cache[key] = func(samples_mask)
+
+            if len(cache) > self.k_cache_size:
+                cache.popitem(last=False)
+
+        return cache[key]
+
+    def std_filters(self, samples_mask):
+        """
+        Positions of the X (only used if x_feature_type="all") and M columns with non-zero standard deviation
+        across the samples in samples_mask.
+
+        :param samples_mask: numpy.array boolean mask of the samples
+        :return: (x positions, m positions)
+        """
+
+        def filters(mask):
+            x_std = np.flatnonzero(np.std(self.x[mask], axis=0) > 0) if self.x_feature_type == "all" else None
+            m_std = np.flatnonzero(np.std(self.m[mask], axis=0) > 0)
+            return x_std, m_std
+
+        return self.__mask_cached(self.std_cache, samples_mask, filters)
+
+    @staticmethod
+    def economic_qs(k, epsilon=np.sqrt(np.finfo(float).eps)):
+        """
+        Economic eigendecomposition of the random effects matrix, K = Q0 * S0 * Q0'.
+
+        :param k: numpy.array symmetric matrix
+        :param epsilon: eigenvalues smaller than epsilon are considered zero
+        :return: ((Q0, Q1), S0)
+        """
+        s, q = np.linalg.eigh(k)
+
+        ok = s >= epsilon
 
-        return y_, y_nans_idx, x_, x_vars, m_, k_
+        return (q[:, ok], q[:, ~ok]), s[ok]
+
+    def k_qs(self, samples_mask):
+        """
+        Eigendecomposition of the random effects matrix subset to the samples in samples_mask. Decompositions are
+        cached by sample mask, hence computed once for all the Y variables with the same missing values.
+
+        :param samples_mask: numpy.array boolean mask of the samples
+        :return: ((Q0, Q1), S0)
+        """
+        return self.__mask_cached(
+            self.k_qs_cache,
+            samples_mask,
+            lambda mask: self.economic_qs(self.k[np.ix_(mask, mask)]),
+        )
+
+    def mask_batches(self, y_vars):
+        """
+        Group Y variables sharing the same samples mask, so that each batch reuses one K eigendecomposition.
+
+        :param y_vars: list of Y variables
+        :return: list of lists of Y variables
+        """
+        batches = OrderedDict()
+        for y_var in y_vars:
+            key = np.packbits(~np.isnan(self.y[:, self.y_pos[y_var]])).tobytes()
+            batches.setdefault(key, []).append(y_var)
+
+        return list(batches.values())
 
     @staticmethod
     def log_likelihood(y_true, y_pred):
@@ -367,22 +635,35 @@ class LMModels:
         :param y_var: String y variable name
         :return: pandas.DataFrame of the associations
         """
-        import limix
-
-        y_, y_nans_idx, x_, x_vars, m_, k_ = self.__prepare_inputs__(y_var)
+        y_, y_nans_idx, x_, x_vars, m_ = self.__prepare_inputs__(y_var)
 
         # Linear Mixed Model
-        lmm = limix.qtl.scan(G=x_, Y=y_, K=k_, M=m_, lik=self.lik, verbose=False)
+        if self.backend == "numpy":
+            lmm = FastLMM(y_, m_, self.k_qs(~y_nans_idx))
+            beta, beta_se, pval = lmm.scan(x_)
+
+        elif self.lik == "normal":
+            beta, beta_se, pval = self.lmm_scan(y_, x_, m_, self.k_qs(~y_nans_idx))
+
+        else:
+            import limix
+
+            k_ = self.k[:, ~y_nans_idx][~y_nans_idx, :]
+            lmm = limix.qtl.scan(G=x_, Y=y_, K=k_, M=m_, lik=self.lik, verbose=False)
+
+            lmm_betas = lmm.effsizes["h2"].query("effect_type == 'candidate'")
+            beta = lmm_betas["effsize"].values
+            beta_se = lmm_betas["effsize_se"].values
+            pval = lmm.stats.loc[lmm_betas["test"], "pv20"].values
 
         # Build results
-        lmm_betas = lmm.effsizes["h2"].query("effect_type == 'candidate'")
         lmm = pd.DataFrame(
             dict(
                 y_id=y_var,
                 x_id=x_vars,
-                beta=list(lmm_betas["effsize"].round(5)),
-                beta_se=list(lmm_betas["effsize_se"].round(5)),
-                pval=list(lmm.stats.loc[lmm_betas["test"], "pv20"]),
+                beta=np.round(beta, 5),
+                beta_se=np.round(beta_se, 5),
+                pval=pval,
                 nsamples=sum(1 - y_nans_idx),
                 ncovariates=m_.shape[1],
             )
@@ -390,13 +671,134 @@ class LMModels:
 
         return lmm
 
-    def matrix_lmm(self, pval_adj="fdr_bh", pval_adj_overall=False):
-        # Iterate through Y variables
-        res = []
+    @staticmethod
+    def lmm_scan(y, x, m, qs):
+        """
+        Normal likelihood linear mixed model scan (as limix.qtl.scan), using a precomputed eigendecomposition of K.
+        The null model is fitted once and each column of x is tested with a likelihood-ratio test.
+
+        :param y: numpy.array (n, 1)
+        :param x: numpy.array (n, p) candidate features
+        :param m: numpy.array (n, c) covariates
+        :param qs: ((Q0, Q1), S0) eigendecomposition of K
+        :return: (beta, beta_se, pval) arrays of size p
+        """
+        from glimix_core.lmm import LMM
+
+        # Null model
+        lmm = LMM(y.ravel(), m, qs, restricted=False)
+        lmm.fit(verbose=False)
+        lml0 = lmm.lml()
+
+        # Alternative models
+        scanner = lmm.get_fast_scanner()
+        res = [scanner.scan(x[:, [i]]) for i in range(x.shape[1])]
 
-        for y_var in self.y_columns:
-            res.append(self.lmm(y_var=y_var))
+        beta = np.array([r["effsizes1"][0] for r in res])
+        beta_se = np.array([r["effsizes1_se"][0] for r in res])
+        pval = chi2(1).sf(2 * (np.array([r["lml"] for r in res]) - lml0))
 
+        return beta, beta_se, pval
+
+    @staticmethod
+    def lmm_part_file(output_folder, y_var):
+        return f"{output_folder}/{y_var}.csv.gz"
+
+    def __lmm_iter(self, y_vars, n_jobs=1, chunk_size=32):
+        """
+        Iterate over the fitted Y variables, in order of completion. Y variables are scheduled in batches sharing
+        the same samples mask, so each batch decomposes K once.
+
+        :param y_vars: list of Y variables
+        :param n_jobs: number of processes, Y variables are fitted serially if 1
+        :param chunk_size: maximum number of Y variables submitted per task
+        :return: generator of (y_var, pandas.DataFrame)
+        """
+        batches = self.mask_batches(y_vars)
+
+        if n_jobs == 1:
+            for batch in batches:
+                for y_var in batch:
+                    yield y_var, self.lmm(y_var=y_var)
+
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_lmm_worker_init, initargs=(self,)
+            ) as executor:
+                # Split large batches so they are spread across the workers
+                futures = [
+                    executor.submit(_lmm_worker, batch[i : i + chunk_size])
+                    for batch in batches
+                    for i in range(0, len(batch), chunk_size)
+                ]
+
+                for future in as_completed(futures):
+                    yield from future.result()
+
+    def run_lmm(self, y_vars=None, output_folder=None, n_jobs=1):
+        """
+        Schedule the linear mixed models of the Y variables across a process pool. If output_folder is provided,
+        each result is written to a per-Y part file as soon as it completes and Y variables with an existing part
+        file are skipped, i.e. interrupted runs can be resumed.
+
+        :param y_vars: list of Y variables (default: all)
+        :param output_folder: String folder to write the per-Y part files
+        :param n_jobs: number of processes
+        :return: list of pandas.DataFrame, one per Y variable
+        """
+        y_vars = list(self.y_columns if y_vars is None else y_vars)
+
+        # Skip Y variables already fitted
+        if output_folder is not None:
+            os.makedirs(output_folder, exist_ok=True)
+
+            y_todo = [
+                i
+                for i in y_vars
+                if not os.path.exists(self.lmm_part_file(output_folder, i))
+            ]
+
+            if len(y_todo) < len(y_vars):
+                LOG.info(f"Skipping {len(y_vars) - len(y_todo)} Y variables already fitted")
+
+        else:
+            y_todo = y_vars
+
+        # Fit models
+        res, start = {}, time.time()
+
+        for i, (y_var, y_res) in enumerate(self.__lmm_iter(y_todo, n_jobs=n_jobs)):
+            if output_folder is not None:
+                # Written atomically so preempted runs do not leave truncated part files
+                Store.atomic_write(
+                    self.lmm_part_file(output_folder, y_var),
+                    lambda f: y_res.to_csv(f, index=False, compression="gzip"),
+                )
+
+            else:
+                res[y_var] = y_res
+
+            if self.verbose > 0:
+                elapsed = time.time() - start
+                eta = elapsed / (i + 1) * (len(y_todo) - i - 1)
+                LOG.info(
+                    f"LMM {i + 1}/{len(y_todo)} ({y_var}); elapsed: {elapsed:.0f}s; ETA: {eta:.0f}s"
+                )
+
+        # Merge results
+        if output_folder is not None:
+            res = [pd.read_csv(self.lmm_part_file(output_folder, i)) for i in y_vars]
+
+        else:
+            res = [res[i] for i in y_vars]
+
+        return res
+
+    def matrix_lmm(
+        self, pval_adj="fdr_bh", pval_adj_overall=False, n_jobs=1, output_folder=None
+    ):
+        # Iterate through Y variables
+        res = self.run_lmm(output_folder=output_folder, n_jobs=n_jobs)
         res = pd.concat(res, ignore_index=True)
 
         # Multiple p-value correction
@@ -408,11 +810,8 @@ class LMModels:
 
         return res.sort_values("fdr")[self.RES_ORDER]
 
-    def write_lmm(self, output_folder):
-        for i in self.y_columns:
-            self.lmm(y_var=i).to_csv(
-                f"{output_folder}/{i}.csv.gz", index=False, compression="gzip"
-            )
+    def write_lmm(self, output_folder, n_jobs=1):
+        self.run_lmm(output_folder=output_folder, n_jobs=n_jobs)
 
     @staticmethod
     def multipletests(
@@ -431,37 +830,82 @@ class LMModels:
         return parsed_results_adj
 
     @staticmethod
-    def transform_matrix(matrix, t_type="scale", add_nan_mask=True, fillna_func=np.mean):
-        # Create mask attribute
-        mask_df = matrix.notna()
+    def transform_matrix(matrix, t_type="scale", add_nan_mask=True, fillna_func=np.nanmean):
+        """
+        Fill missing values and transform the matrix (samples x features).
+
+        :param matrix: pandas.DataFrame
+        :param t_type: String transformation, "scale" (features standardised) or "rank" (features ranked per sample)
+        :param add_nan_mask: Boolean store the packed mask of non-missing values in attrs["nan_mask"]
+        :param fillna_func: NaN-aware reduction with an axis argument used to fill the NaNs of each sample (row),
+            e.g. np.nanmean or np.nanmedian. NaNs are kept if None. It is called once on the samples x features
+            array, not per row (pandas.DataFrame.apply) as before: np.mean and np.median are replaced by their
+            NaN-aware versions, and a ValueError is raised if NaNs remain in samples with measured values.
+        :return: pandas.DataFrame
+        """
+        values = matrix.to_numpy(dtype=np.float64, copy=True)
+        nan_mask = np.isnan(values)
 
         # Fill NaNs
-        if fillna_func is not None:
-            matrix = matrix.T.fillna(matrix.apply(fillna_func, axis=1)).T
+        if fillna_func is not None and nan_mask.any():
+            fill = LMModels.NAN_REDUCTIONS.get(fillna_func, fillna_func)(values, axis=1)
+
+            if np.isnan(fill[~nan_mask.all(1)]).any():
+                raise ValueError(
+                    f"fillna_func {fillna_func} returned NaN for samples with measured values, use a NaN-aware "
+                    "reduction (e.g. np.nanmean)"
+                )
+
+            nan_rows, nan_cols = np.nonzero(nan_mask)
+            values[nan_rows, nan_cols] = fill[nan_rows]
 
         # Type of transformation
         if t_type == "scale":
-            from sklearn.preprocessing import StandardScaler
+            std = np.nanstd(values, axis=0)
+            std[std == 0] = 1
 
-            matrix = pd.DataFrame(
-                StandardScaler().fit_transform(matrix),
-                index=matrix.index,
-                columns=matrix.columns,
-            )
+            values -= np.nanmean(values, axis=0)
+            values /= std
 
         elif t_type == "rank":
-            matrix = matrix.rank(axis=1).values
+            # Remaining NaNs (not filled) are ranked last, hence the ranks of the other values are unaffected
+            values_nan = np.isnan(values)
+
+            values = rankdata(np.where(values_nan, np.inf, values), axis=1)
+            values[values_nan] = np.nan
 
         else:
             LOG.warning(
                 f"{t_type} transformation not supported. Original matrix returned."
             )
 
+        matrix = pd.DataFrame(values, index=matrix.index, columns=matrix.columns)
+
         if add_nan_mask:
-            matrix.attrs["nan_mask"] = mask_df.loc[matrix.index, matrix.columns]
+            matrix.attrs["nan_mask"] = dict(
+                bits=np.packbits(~nan_mask, axis=0),
+                index=matrix.index,
+                columns=matrix.columns,
+            )
 
         return matrix
 
+    @staticmethod
+    def nan_mask(matrix):
+        """
+        Unpack the mask of non-missing values stored by transform_matrix.
+
+        :param matrix: pandas.DataFrame returned by transform_matrix
+        :return: pandas.DataFrame boolean
+        """
+        mask = matrix.attrs["nan_mask"]
+
+        return pd.DataFrame(
+            np.unpackbits(mask["bits"], axis=0, count=len(mask["index"])).astype(bool),
+            index=mask["index"],
+            columns=mask["columns"],
+        )
+
     @staticmethod
     def define_covariates(
         std_filter=True,
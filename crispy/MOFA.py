@@ -3,7 +3,6 @@
 
 import os
 import h5py
-import gseapy
 import logging
 import matplotlib
 import numpy as np
@@ -12,10 +11,12 @@ import pkg_resources
 import seaborn as sns
 import matplotlib.pyplot as plt
 from adjustText import adjust_text
+from crispy.Store import Store
+from crispy.LMModels import LModel
 from crispy.Enrichment import Enrichment
 from crispy.CrispyPlot import CrispyPlot
 from mofapy2.run.entry_point import entry_point
-from sklearn.linear_model import LinearRegression
+from statsmodels.stats.multitest import multipletests
 
 LOG = logging.getLogger("Crispy")
 DPATH = pkg_resources.resource_filename("crispy", "data")
@@ -102,26 +103,8 @@ class MOFA:
             self.views = self.regress_out_covariates(fit_intercept=self.fit_intercept)
 
         # RUN MOFA
-        # Prepare data, melt & tidy
-        self.data = []
-
-        for k in self.views_labels:
-            df = self.views[k].copy()
-            df.index.name = "feature"
-            df.columns.name = "sample"
-
-            df = df.unstack().rename("value").reset_index()
-
-            if groupby is not None:
-                df["group"] = groupby.reindex(df["sample"]).values
-
-            else:
-                df = df.assign(group="gdsc")
-
-            self.data.append(df.assign(view=k))
-
-        self.data = pd.concat(self.data, ignore_index=True)
-        self.data = self.data[["sample", "group", "feature", "value", "view"]].dropna()
+        # Prepare data, float32 matrices (samples x features) per view and group
+        self.data, self.groups, self.features = self.build_data_matrices(groupby)
 
         # Initialise entry point
         self.ep = entry_point()
@@ -130,7 +113,14 @@ class MOFA:
         self.ep.set_data_options(
             scale_groups=self.scale_groups, scale_views=self.scale_views
         )
-        self.ep.set_data_df(self.data, likelihoods=self.likelihoods)
+        self.ep.set_data_matrix(
+            self.data,
+            likelihoods=self.likelihoods,
+            views_names=self.views_labels,
+            groups_names=list(self.groups),
+            samples_names=[self.groups[g] for g in self.groups],
+            features_names=[self.features[k] for k in self.views_labels],
+        )
 
         # Set model options
         self.ep.set_model_options(factors=self.factors_n)
@@ -152,93 +142,89 @@ class MOFA:
             self.ep.run()
             self.save_hdf5(self.from_file)
 
-        self.mofa_file = h5py.File(self.from_file, "r")
+        self.results = MOFAResults(self.from_file)
 
-        self.factors = self.get_factors(self.mofa_file)
-        self.weights = self.get_weights(self.mofa_file)
-        self.rsquare = self.get_rsquare(self.mofa_file)
+        self.factors = self.results.factors
+        self.weights = self.results.weights
+        self.rsquare = self.results.rsquare
 
-    @staticmethod
-    def get_factors(mofa_hdf5):
-        factors_n = int(mofa_hdf5["training_stats"]["number_factors"][0])
-        factors_labels = [f"F{i + 1}" for i in range(factors_n)]
+    def build_data_matrices(self, groupby=None):
+        """
+        Assemble the views as float32 matrices (samples x features) per view and group, as expected by
+        entry_point.set_data_matrix. Features and samples without measurements are removed and samples without
+        group are excluded.
 
-        z = mofa_hdf5["expectations"]["Z"]
-        factors = pd.concat(
-            [
-                pd.DataFrame(
-                    df,
-                    columns=[s.decode("utf-8") for s in mofa_hdf5["samples"][k]],
-                    index=factors_labels,
-                ).T
-                for k, df in z.items()
-            ]
+        :param groupby: pandas.Series group of each sample (default: single group "gdsc")
+        :return: list (views) of lists (groups) of numpy.array, dict(group: list of samples),
+            dict(view: list of features)
+        """
+        # Measured features, as float32
+        values, features = {}, {}
+        for k in self.views_labels:
+            measured = self.views[k].notna().any(axis=1).values
+
+            values[k] = self.views[k].to_numpy(dtype=np.float32)[measured]
+            features[k] = list(self.views[k].index[measured])
+
+        # Samples with measurements in any view
+        samples = pd.Index(
+            dict.fromkeys(s for k in self.views_labels for s in self.views[k].columns)
         )
-        return factors
+        samples_measured = np.zeros(len(samples), dtype=bool)
+        for k in self.views_labels:
+            samples_measured[samples.get_indexer(self.views[k].columns)] |= (
+                ~np.isnan(values[k])
+            ).any(axis=0)
+        samples = samples[samples_measured]
 
-    @staticmethod
-    def get_weights(mofa_hdf5):
-        factors_n = int(mofa_hdf5["training_stats"]["number_factors"][0])
-        factors_labels = [f"F{i + 1}" for i in range(factors_n)]
+        # Groups
+        if groupby is None:
+            groups = pd.Series("gdsc", index=samples)
 
-        w = mofa_hdf5["expectations"]["W"]
-        weights = {
-            n: pd.DataFrame(
-                w[n].value.T,
-                index=[f.decode("utf-8") for f in mofa_hdf5["features"][n]],
-                columns=factors_labels,
-            )
-            for n, df in w.items()
-        }
-        return weights
+        else:
+            groups = groupby.reindex(samples).dropna()
 
-    @staticmethod
-    def get_rsquare(mofa_hdf5):
-        factors_n = int(mofa_hdf5["training_stats"]["number_factors"][0])
-        factors_labels = [f"F{i + 1}" for i in range(factors_n)]
+        groups = {g: list(groups.index[groups == g]) for g in groups.unique()}
 
-        r2 = mofa_hdf5["variance_explained"]["r2_per_factor"]
-        rsquare = {
-            k: pd.DataFrame(
-                df,
-                index=[s.decode("utf-8") for s in mofa_hdf5["views"]["views"]],
-                columns=factors_labels,
-            )
-            for k, df in r2.items()
-        }
-        return rsquare
+        # Views x groups matrices, samples missing in a view are NaN
+        data = []
+        for k in self.views_labels:
+            data_k = []
 
-    @classmethod
-    def read_mofa_hdf5(cls, hdf5_file):
-        mofa_hdf5 = h5py.File(hdf5_file, "r")
+            for g in groups:
+                idx = self.views[k].columns.get_indexer(groups[g])
 
-        factors = cls.get_factors(mofa_hdf5)
-        weights = cls.get_weights(mofa_hdf5)
-        rsquare = cls.get_rsquare(mofa_hdf5)
+                m = np.full((len(idx), values[k].shape[0]), np.nan, dtype=np.float32)
+                m[idx >= 0] = values[k][:, idx[idx >= 0]].T
 
-        return factors, weights, rsquare
+                data_k.append(m)
 
-    @staticmethod
-    def lm_residuals(y, x, fit_intercept=True, add_intercept=False):
-        # Prepare input matrices
-        ys = y.dropna()
-        xs = x.loc[ys.index]
-        xs = xs.loc[:, xs.std() > 0]
+            data.append(data_k)
 
-        if ys.shape[0] <= xs.shape[1]:
-            return None
+        return data, groups, features
 
-        # Linear regression models
-        lm = LinearRegression(fit_intercept=fit_intercept).fit(xs, ys)
+    @staticmethod
+    def get_factors(mofa_hdf5):
+        return MOFAResults.read_factors(mofa_hdf5)
 
-        # Calculate residuals
-        residuals = ys - lm.predict(xs) - lm.intercept_
+    @staticmethod
+    def get_weights(mofa_hdf5):
+        return MOFAResults.read_weights(mofa_hdf5)
 
-        # Add intercept
-        if add_intercept:
-            residuals += lm.intercept_
+    @staticmethod
+    def get_rsquare(mofa_hdf5):
+        return MOFAResults.read_rsquare(mofa_hdf5)
 
-        return residuals
+    @classmethod
+    def read_mofa_hdf5(cls, hdf5_file):
+        results = MOFAResults(hdf5_file)
+        return results.factors, results.weights, results.rsquare
+
+    @staticmethod
+    def lm_residuals(y, x, fit_intercept=True, add_intercept=False):
+        return LModel.lm_residuals(
+            y, x, fit_intercept=fit_intercept, add_intercept=add_intercept
+        )
 
     def regress_out_covariates(self, fit_intercept=True, add_intercept=True):
         views_ = {}
@@ -262,17 +248,12 @@ class MOFA:
                         f"Regressing-out covariates (N={cov.shape}) from {k} view"
                     )
 
-                # Regress-out
-                views_[k] = pd.DataFrame(
-                    {
-                        i: self.lm_residuals(
-                            self.views[k].loc[i],
-                            cov,
-                            fit_intercept=fit_intercept,
-                            add_intercept=add_intercept,
-                        )
-                        for i in self.views[k].index
-                    }
+                # Regress-out, all features at once
+                views_[k] = LModel.lm_residuals_matrix(
+                    self.views[k].T,
+                    cov,
+                    fit_intercept=fit_intercept,
+                    add_intercept=add_intercept,
                 ).T[self.samples]
 
             else:
@@ -281,8 +262,29 @@ class MOFA:
         return views_
 
     def pathway_enrichment(
-        self, factor, views=None, genesets=None, nprocesses=4, permutation_num=0
+        self,
+        factor=None,
+        views=None,
+        genesets=None,
+        nprocesses=4,
+        permutation_num=0,
+        min_size=15,
+        seed=None,
     ):
+        """
+        ssGSEA of the factors weights, for all the factors, views and gene-set collections in one call. Gene-sets
+        are loaded once, every factor of a view is scored at once and all views and collections share a single
+        pool of processes (Enrichment.gsea_matrices).
+
+        :param factor: String factor, list of factors or None (all factors)
+        :param views: list of views
+        :param genesets: list of GMT files
+        :param nprocesses: number of processes
+        :param permutation_num: number of permutations, NES and p-values are NaN if 0
+        :param min_size: minimum number of gene-set genes measured in the view
+        :param seed: int random seed of the permutations
+        :return: pandas.DataFrame with factor, view, geneset, gset, e_score, nes, p_value and adj.p_value
+        """
         if genesets is None:
             genesets = [
                 "c6.all.v7.1.symbols.gmt",
@@ -294,24 +296,54 @@ class MOFA:
         if views is None:
             views = ["methylation", "transcriptomics", "proteomics"]
 
-        df = pd.concat(
-            [
-                gseapy.ssgsea(
-                    self.weights[v][factor],
-                    processes=nprocesses,
-                    permutation_num=permutation_num,
-                    gene_sets=Enrichment.read_gmt(f"{DPATH}/pathways/{g}"),
-                    no_plot=True,
+        if factor is None:
+            factor = self.factors_labels
+
+        elif type(factor) is str:
+            factor = [factor]
+
+        enr = Enrichment(
+            gmts=genesets,
+            sig_min_len=min_size,
+            permutations=permutation_num,
+            seed=seed,
+            n_jobs=nprocesses,
+        )
+
+        # All views and collections share a single pool of processes
+        jobs = [(v, g) for v in views for g in genesets]
+        res = enr.gsea_matrices([(self.weights[v][factor], g) for v, g in jobs])
+
+        df = []
+        for (v, g), (e_scores, p_values, nes) in zip(jobs, res):
+            df.append(
+                pd.concat(
+                    [
+                        e_scores.unstack().rename("e_score"),
+                        nes.unstack().rename("nes"),
+                        p_values.unstack().rename("p_value"),
+                    ],
+                    axis=1,
                 )
-                .res2d.assign(geneset=g)
-                .assign(view=v)
+                .rename_axis(["gset", "factor"])
                 .reset_index()
-                for v in views
-                for g in genesets
-            ],
-            ignore_index=True,
-        )
-        df = df.rename(columns={"sample1": "nes"}).sort_values("nes")
+                .assign(view=v, geneset=g)
+            )
+
+        df = pd.concat(df, ignore_index=True)
+
+        if permutation_num > 0:
+            df["adj.p_value"] = df.groupby(["factor", "view", "geneset"])["p_value"].transform(
+                lambda p: multipletests(p, method="fdr_bh")[1]
+            )
+
+        else:
+            df["adj.p_value"] = np.nan
+
+        df = df[
+            ["factor", "view", "geneset", "gset", "e_score", "nes", "p_value", "adj.p_value"]
+        ].sort_values("nes" if permutation_num > 0 else "e_score")
+
         return df
 
     def get_top_features(self, view, factor, n_features=30):
@@ -326,6 +358,135 @@ class MOFA:
         self.ep.save(outfile)
 
 
+class MOFAResults:
+    """
+    Lazy access to a trained MOFA model (HDF5 file). Factors, weights and variance explained are parsed on first
+    access and cached as Parquet files alongside the model file (Store.cached), the cache is rebuilt if the
+    modification time or size of the model file differs from the one recorded when the cache was written.
+    """
+
+    def __init__(self, hdf5_file, cache=True):
+        self.hdf5_file = hdf5_file
+        self.cache = cache
+
+        self._factors = None
+        self._weights = None
+        self._rsquare = None
+
+    @property
+    def factors(self):
+        if self._factors is None:
+            self._factors = self.__load("factors", self.read_factors)
+
+        return self._factors
+
+    @property
+    def weights(self):
+        if self._weights is None:
+            weights = self.__load(
+                "weights",
+                lambda f: pd.concat(self.read_weights(f), names=["view", "feature"]),
+            )
+            self._weights = {
+                v: df.loc[v].rename_axis(None)
+                for v, df in weights.groupby(level="view", sort=False)
+            }
+
+        return self._weights
+
+    @property
+    def rsquare(self):
+        if self._rsquare is None:
+            rsquare = self.__load(
+                "rsquare",
+                lambda f: pd.concat(self.read_rsquare(f), names=["group", "view"]),
+            )
+            self._rsquare = {
+                g: df.loc[g].rename_axis(None)
+                for g, df in rsquare.groupby(level="group", sort=False)
+            }
+
+        return self._rsquare
+
+    def cache_file(self, name):
+        return f"{os.path.splitext(self.hdf5_file)[0]}.{name}.parquet"
+
+    def __load(self, name, read_func):
+        """
+        Read a matrix from the Parquet cache if up to date, otherwise parse it from the HDF5 file and cache it.
+        """
+
+        def build():
+            with h5py.File(self.hdf5_file, "r") as f:
+                return read_func(f)
+
+        return Store.cached(
+            self.cache_file(name),
+            [self.hdf5_file],
+            build,
+            pd.read_parquet,
+            lambda df, f: df.to_parquet(f),
+            cache=self.cache,
+            name="MOFA results cache",
+        )
+
+    @staticmethod
+    def decode(dataset):
+        return list(np.char.decode(dataset[()].astype(bytes), "utf-8"))
+
+    @staticmethod
+    def factors_labels(mofa_hdf5):
+        factors_n = int(mofa_hdf5["training_stats"]["number_factors"][0])
+        return [f"F{i + 1}" for i in range(factors_n)]
+
+    @classmethod
+    def read_factors(cls, mofa_hdf5):
+        factors_labels = cls.factors_labels(mofa_hdf5)
+
+        z = mofa_hdf5["expectations"]["Z"]
+        factors = pd.concat(
+            [
+                pd.DataFrame(
+                    df[()],
+                    columns=cls.decode(mofa_hdf5["samples"][k]),
+                    index=factors_labels,
+                ).T
+                for k, df in z.items()
+            ]
+        )
+        return factors
+
+    @classmethod
+    def read_weights(cls, mofa_hdf5):
+        factors_labels = cls.factors_labels(mofa_hdf5)
+
+        w = mofa_hdf5["expectations"]["W"]
+        weights = {
+            n: pd.DataFrame(
+                df[()].T,
+                index=cls.decode(mofa_hdf5["features"][n]),
+                columns=factors_labels,
+            )
+            for n, df in w.items()
+        }
+        return weights
+
+    @classmethod
+    def read_rsquare(cls, mofa_hdf5):
+        factors_labels = cls.factors_labels(mofa_hdf5)
+
+        r2 = mofa_hdf5["variance_explained"]["r2_per_factor"]
+        rsquare = {
+            k: pd.DataFrame(
+                df[()],
+                index=cls.decode(mofa_hdf5["views"]["views"]),
+                columns=factors_labels,
+            )
+            for k, df in r2.items()
+        }
+        return rsquare
+
+
 class MOFAPlot(CrispyPlot):
     @classmethod
     def factors_corr_clustermap(cls, mofa_obj, method="pearson", cmap="RdBu_r"):
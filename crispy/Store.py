@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+
+LOG = logging.getLogger("Crispy")
+
+
+class Store:
+    """
+    Columnar store of the data-release files. Each text file (CSV/TSV) is parsed once and converted, next to the
+    original file, into a typed binary format:
+
+        - numeric matrices: values as a .npy array (memory-mapped on load) plus index and columns (.npz);
+        - tables: Parquet file.
+
+    Conversions are keyed by the parsing arguments and rebuilt if the original file changes.
+
+    Store.cached is the generic disk cache of the package (e.g. STRING network): files are written atomically and
+    the signature of the source files is stored next to the cache (.json) and checked on load.
+
+    """
+
+    @staticmethod
+    def store_file(file_path, read_kws, dtype=None):
+        key = json.dumps(dict(read_kws=read_kws, dtype=str(dtype)), sort_keys=True)
+        key = hashlib.md5(key.encode()).hexdigest()[:8]
+        return f"{file_path}.{key}"
+
+    @staticmethod
+    def file_md5(file_path, block_size=2 ** 20):
+        md5 = hashlib.md5()
+
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                md5.update(block)
+
+        return md5.hexdigest()
+
+    @classmethod
+    def signature(cls, file_paths, content=False, previous=None):
+        """
+        Signature of the source files of a cache: modification time (ns) and size of each file and, if content, its
+        md5. Hashes of a previous signature are reused for files with the same modification time and size.
+
+        :param file_paths: list of file paths
+        :param content: Boolean hash the content of the files
+        :param previous: list previous signature
+        :return: list of dict (JSON serialisable)
+        """
+        previous = {} if previous is None else {i["file"]: i for i in previous}
+
+        signature = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+
+            s = dict(
+                file=os.path.basename(file_path), stat=[stat.st_mtime_ns, stat.st_size]
+            )
+
+            if content:
+                p = previous.get(s["file"], {})
+
+                if p.get("stat") == s["stat"] and "md5" in p:
+                    s["md5"] = p["md5"]
+
+                else:
+                    s["md5"] = cls.file_md5(file_path)
+
+            signature.append(s)
+
+        return signature
+
+    @staticmethod
+    def same_signature(signature, other):
+        """
+        Signatures match if the files have the same content (md5), or if not hashed the same modification time and
+        size.
+        """
+        if signature is None or other is None:
+            return False
+
+        return [(i["file"], i.get("md5", i["stat"])) for i in signature] == [
+            (i["file"], i.get("md5", i["stat"])) for i in other
+        ]
+
+    @staticmethod
+    def atomic_write(file_path, write_func):
+        """
+        Write a file atomically: write_func writes a temporary file which then replaces file_path, so interrupted
+        runs never leave truncated files.
+
+        :param file_path: String file path
+        :param write_func: function taking the temporary file path
+        """
+        tmp_file = f"{file_path}.tmp"
+
+        try:
+            write_func(tmp_file)
+            os.replace(tmp_file, file_path)
+
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    @classmethod
+    def read_signature(cls, file_path):
+        try:
+            with open(file_path) as f:
+                signature = json.load(f)
+
+        except (OSError, ValueError):
+            return None
+
+        return signature if isinstance(signature, list) else None
+
+    @classmethod
+    def cached(
+        cls,
+        cache_file,
+        sources,
+        build_func,
+        read_func,
+        write_func,
+        cache=True,
+        write=True,
+        content=False,
+        name="Cache",
+    ):
+        """
+        Disk cache of an object built from source files. The signature of the sources is written next to the cache
+        file ({cache_file}.json) once the cache is written, and the object is rebuilt if the sources changed. Errors
+        reading or writing the cache (e.g. read-only data directory, missing Parquet engine) are logged and the
+        object is built instead.
+
+        :param cache_file: String file path of the cache
+        :param sources: list of file paths the object is built from
+        :param build_func: function returning the object
+        :param read_func: function reading the object from a file path, returns None if the cache is not usable
+        :param write_func: function writing the object (first argument) to a file path
+        :param cache: Boolean use the cache (read and write)
+        :param write: Boolean write the cache if the object is built
+        :param content: Boolean compare the content (md5) of the sources instead of modification time and size
+        :param name: String name of the cache in log messages
+        :return: object
+        """
+        if not cache:
+            return build_func()
+
+        signature_file = f"{cache_file}.json"
+
+        previous = cls.read_signature(signature_file)
+        signature = cls.signature(sources, content=content, previous=previous)
+
+        if cls.same_signature(previous, signature) and os.path.isfile(cache_file):
+            try:
+                obj = read_func(cache_file)
+
+            except (ImportError, KeyError, OSError, ValueError) as e:
+                LOG.warning(f"{name} not read {cache_file}: {e}")
+                obj = None
+
+            if obj is not None:
+                # Sources touched but unchanged
+                if previous != signature:
+                    cls.write_signature(signature_file, signature, name)
+
+                return obj
+
+        obj = build_func()
+
+        if not write:
+            return obj
+
+        try:
+            cls.atomic_write(cache_file, lambda f: write_func(obj, f))
+
+        except (ImportError, OSError, TypeError, ValueError) as e:
+            LOG.warning(f"{name} not written {cache_file}: {e}")
+
+        else:
+            cls.write_signature(signature_file, signature, name)
+
+        return obj
+
+    @classmethod
+    def write_signature(cls, file_path, signature, name="Cache"):
+        def write(f):
+            with open(f, "w") as fh:
+                json.dump(signature, fh)
+
+        try:
+            cls.atomic_write(file_path, write)
+
+        except OSError as e:
+            LOG.warning(f"{name} signature not written {file_path}: {e}")
+
+    @staticmethod
+    def encode_labels(labels):
+        values = np.asarray(labels)
+
+        if values.dtype == object:
+            if not all(isinstance(v, str) for v in values):
+                raise TypeError(f"Labels of mixed types not supported: {labels.name}")
+
+            values = values.astype(str)
+
+        return values
+
+    @staticmethod
+    def decode_labels(values, name):
+        if values.dtype.kind == "U":
+            values = values.astype(object)
+
+        return pd.Index(values, name=name if name != "" else None)
+
+    @classmethod
+    def matrix(cls, file_path, dtype=np.float32, cache=True, **read_kws):
+        """
+        Read a numeric matrix (e.g. genes x samples), from the store if up to date otherwise parse the text file
+        with pandas.read_csv and convert it.
+
+        :param file_path: String file path
+        :param dtype: numpy dtype of the values
+        :param cache: Boolean write the converted matrix to the store
+        :param read_kws: arguments passed to pandas.read_csv
+        :return: pandas.DataFrame (values memory-mapped, copy-on-write)
+        """
+        store_file = cls.store_file(file_path, read_kws, dtype)
+
+        def read(values_file):
+            with np.load(f"{store_file}.npz") as f:
+                index = cls.decode_labels(f["index"], str(f["index_name"]))
+                columns = cls.decode_labels(f["columns"], str(f["columns_name"]))
+
+            values = np.load(values_file, mmap_mode="c")
+
+            return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+        def write(df, values_file):
+            index = cls.encode_labels(df.index)
+            columns = cls.encode_labels(df.columns)
+
+            def write_labels(f):
+                with open(f, "wb") as fh:
+                    np.savez(
+                        fh,
+                        index=index,
+                        columns=columns,
+                        index_name=str(df.index.name or ""),
+                        columns_name=str(df.columns.name or ""),
+                    )
+
+            cls.atomic_write(f"{store_file}.npz", write_labels)
+
+            with open(values_file, "wb") as f:
+                np.save(f, np.ascontiguousarray(df.values))
+
+        return cls.cached(
+            f"{store_file}.npy",
+            [file_path],
+            lambda: pd.read_csv(file_path, **read_kws).astype(dtype),
+            read,
+            write,
+            write=cache,
+            name="Store matrix",
+        )
+
+    @classmethod
+    def table(cls, file_path, cache=True, **read_kws):
+        """
+        Read a table (e.g. long format or mixed types), from the store if up to date otherwise parse the text file
+        with pandas.read_csv and convert it to Parquet.
+
+        :param file_path: String file path
+        :param cache: Boolean write the converted table to the store
+        :param read_kws: arguments passed to pandas.read_csv
+        :return: pandas.DataFrame
+        """
+        return cls.cached(
+            f"{cls.store_file(file_path, read_kws)}.parquet",
+            [file_path],
+            lambda: pd.read_csv(file_path, **read_kws),
+            pd.read_parquet,
+            lambda df, f: df.to_parquet(f),
+            write=cache,
+            name="Store table",
+        )
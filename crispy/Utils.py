@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
+import warnings
 import numpy as np
 import pandas as pd
 import pkg_resources
@@ -343,6 +344,90 @@ class Utils(object):
 
         return dict(corr=r, pval=p, len=len(idx_set))
 
+    @staticmethod
+    def pairs_correlation(
+        df, pairs=None, method="pearson", min_periods=1, chunk_size=512
+    ):
+        """
+        Correlation between pairs of columns with pairwise complete observations (equivalent to pandas.DataFrame.corr
+        for the requested pairs). Columns are standardised once and correlations obtained from dot products of the
+        pairwise complete observations, all pairs at once (pairs=None) or in chunks of pairs.
+
+        Spearman correlation ranks each column over all its observations, i.e. it matches pandas only for pairs
+        without missing values.
+
+        :param df: pandas.DataFrame observations x samples
+        :param pairs: list-like of (sample_1, sample_2) tuples, if None all pairs in the upper triangle are used
+        :param method: String pearson or spearman
+        :param min_periods: Int minimum number of complete observations for each pair
+        :param chunk_size: Int number of pairs processed at a time
+        :return: pandas.DataFrame with sample_1, sample_2 and corr columns
+        """
+        values = df.values.astype(float)
+
+        if method == "spearman":
+            values = df.rank().values
+
+        measured = ~np.isnan(values)
+
+        # Standardise columns
+        with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            values = (values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0)
+
+        values = np.where(measured, values, 0)
+
+        min_periods = max(2, min_periods)
+
+        if pairs is None:
+            m = measured.astype(float)
+
+            n = m.T @ m
+            sx = values.T @ m
+            sxx = (values ** 2).T @ m
+            sxy = values.T @ values
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                corr = (n * sxy - sx * sx.T) / np.sqrt(
+                    (n * sxx - sx ** 2) * (n * sxx.T - sx.T ** 2)
+                )
+
+            corr[n < min_periods] = np.nan
+
+            idx_1, idx_2 = np.triu_indices(df.shape[1], k=1)
+            corr = corr[idx_1, idx_2]
+
+        else:
+            pairs = np.asarray(pairs)
+            idx_1 = df.columns.get_indexer(pairs[:, 0])
+            idx_2 = df.columns.get_indexer(pairs[:, 1])
+
+            corr = np.full(len(pairs), np.nan)
+
+            for i in range(0, len(pairs), chunk_size):
+                i1, i2 = idx_1[i : i + chunk_size], idx_2[i : i + chunk_size]
+
+                m = measured[:, i1] & measured[:, i2]
+                x, y = values[:, i1] * m, values[:, i2] * m
+
+                n = m.sum(0)
+                sx, sy = x.sum(0), y.sum(0)
+
+                sxx, syy = (x ** 2).sum(0), (y ** 2).sum(0)
+
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    c = (n * (x * y).sum(0) - sx * sy) / np.sqrt(
+                        (n * sxx - sx ** 2) * (n * syy - sy ** 2)
+                    )
+
+                corr[i : i + chunk_size] = np.where(n < min_periods, np.nan, c)
+
+        return pd.DataFrame(
+            dict(
+                sample_1=df.columns[idx_1], sample_2=df.columns[idx_2], corr=corr
+            )
+        )
+
 
 class DotDict(dict):
     __getattr__ = dict.get
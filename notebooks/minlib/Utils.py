@@ -183,13 +183,10 @@ def replicates_correlation(sgrna_data, guides=None, plasmids=None, method="pears
         df = df.remove_low_counts(plasmids).norm_rpm().foldchange(plasmids)
 
     # Sample correlation
-    df_corr = df.corr(method=method)
-    df_corr = df_corr.where(np.triu(np.ones(df_corr.shape), 1).astype(np.bool))
-    df_corr = df_corr.unstack().dropna().reset_index()
-    df_corr.columns = ["sample_1", "sample_2", "corr"]
-    df_corr["replicate"] = [
-        s1.split("_")[0] == s2.split("_")[0]
-        for s1, s2 in df_corr[["sample_1", "sample_2"]].values
-    ]
+    df_corr = Utils.pairs_correlation(df, method=method).dropna()
+    df_corr["replicate"] = (
+        df_corr["sample_1"].str.split("_").str[0]
+        == df_corr["sample_2"].str.split("_").str[0]
+    )
 
     return df_corr
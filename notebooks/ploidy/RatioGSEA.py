@@ -44,7 +44,7 @@ if __name__ == '__main__':
     for gset in cgenes:
         print(f'[INFO] {gset}')
 
-        e_score, p_value, hits, running_hit = cy.SSGSEA.gsea(dataset, cgenes[gset], 10000)
+        e_score, p_value, hits, running_hit = cy.SSGSEA.gsea(dataset, cgenes[gset], 10000, return_hits=True)
 
         ax = cy.GSEAplot.plot_gsea(hits, running_hit)
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import pytest
+import numpy as np
+import pandas as pd
+from crispy.LMModels import FastLMM, LMModels
+
+
+pytest.importorskip("glimix_core")
+
+
+def simulate(n_samples=120, n_features=25, n_covariates=3, rank=None, seed=0):
+    """
+    Simulated y, candidate features x, covariates m (with intercept) and kinship k. If rank is not None k is
+    built from rank random effects, i.e. rank deficient.
+    """
+    rng = np.random.default_rng(seed)
+
+    g = rng.normal(size=(n_samples, n_samples if rank is None else rank))
+    k = g @ g.T / g.shape[1]
+
+    m = np.concatenate(
+        [np.ones((n_samples, 1)), rng.normal(size=(n_samples, n_covariates - 1))], axis=1
+    )
+    x = rng.normal(size=(n_samples, n_features))
+
+    u = g @ rng.normal(size=g.shape[1]) / np.sqrt(g.shape[1])
+    y = m @ rng.normal(size=n_covariates) + 0.5 * x[:, 0] + u + rng.normal(size=n_samples)
+
+    return y.reshape(-1, 1), x, m, k
+
+
+@pytest.mark.parametrize("rank", [None, 30])
+def test_fastlmm_matches_glimix(rank):
+    y, x, m, k = simulate(rank=rank)
+    qs = LMModels.economic_qs(k)
+
+    if rank is not None:
+        assert qs[0][1].shape[1] > 0, "K should be rank deficient"
+
+    beta, beta_se, pval = FastLMM(y, m, qs).scan(x)
+    beta_ref, beta_se_ref, pval_ref = LMModels.lmm_scan(y, x, m, qs)
+
+    np.testing.assert_allclose(beta, beta_ref, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(beta_se, beta_se_ref, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(
+        -np.log10(pval), -np.log10(pval_ref), rtol=1e-4, atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("rank", [None, 30])
+def test_scans_match_limix(rank):
+    limix = pytest.importorskip("limix")
+
+    y, x, m, k = simulate(rank=rank)
+
+    lmm = limix.qtl.scan(G=x, Y=y, K=k, M=m, lik="normal", verbose=False)
+    lmm_betas = lmm.effsizes["h2"].query("effect_type == 'candidate'")
+
+    beta_ref = lmm_betas["effsize"].values
+    pval_ref = lmm.stats.loc[lmm_betas["test"], "pv20"].values
+
+    # limix (glimix-core fast_scan) reports standard errors not multiplied by the scale of the alternative model
+    # when there is more than one covariate
+    scale = lmm.stats.loc[lmm_betas["test"], "scale2"].values
+    beta_se_ref = lmm_betas["effsize_se"].values * np.sqrt(scale)
+
+    qs = LMModels.economic_qs(k)
+
+    for beta, beta_se, pval in [
+        FastLMM(y, m, qs).scan(x),
+        LMModels.lmm_scan(y, x, m, qs),
+    ]:
+        np.testing.assert_allclose(beta, beta_ref, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(beta_se, beta_se_ref, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(
+            -np.log10(pval), -np.log10(pval_ref), rtol=1e-4, atol=1e-6
+        )
+
+
+def test_unknown_backend():
+    with pytest.raises(AssertionError):
+        LMModels(y=None, x=None, k=None, m=None, backend="numpyy")
+
+    with pytest.raises(AssertionError):
+        LMModels(y=None, x=None, k=None, m=None, backend="numpy", lik="bernoulli")
+
+
+def test_transform_matrix_rank_filled():
+    df = pd.DataFrame([[1, np.nan, 3], [4, 5, 6], [7, 8, np.nan]], index=list("abc"))
+
+    ranked = LMModels.transform_matrix(df, t_type="rank")
+    np.testing.assert_array_equal(ranked.loc["c"].values, [1, 3, 2])
+
+    ranked = LMModels.transform_matrix(df, t_type="rank", fillna_func=None)
+    np.testing.assert_array_equal(ranked.loc["c"].values, [1, 2, np.nan])
+
+
+def test_transform_matrix_fillna_func():
+    df = pd.DataFrame([[1, np.nan, 3], [4, 5, 6]], index=list("ab"))
+
+    filled = LMModels.transform_matrix(df, t_type=None, fillna_func=np.mean)
+    np.testing.assert_array_equal(filled.loc["a"].values, [1, 2, 3])
+
+    with pytest.raises(ValueError):
+        LMModels.transform_matrix(df, t_type=None, fillna_func=np.sum)